@@ -0,0 +1,58 @@
+"""Benchmark of the internal unit systems of CESim.run_sims (see PyCESim.unit_system_dict).
+
+For each molecule, the final velocities are compared with a tight tolerance reference run, for a sweep
+of solver tolerances (rtol = atol) in SI and in natural units (angstrom, fs, u, e). For each unit system
+the cheapest tolerance that reaches the target accuracy is reported, with its mean number of
+function evaluations (nfev) per simulation and the wall time.
+
+Run from the Examples folder: python benchmark_units.py
+"""
+import time
+import numpy as np
+import PyCESim
+
+target_error = 1e-4
+tol_list = [1e-3, 1e-4, 1e-5, 1e-6, 1e-7]
+
+
+def make_sim(fname, n_sims, channel_list, sigma, t_range_list, n_step_list):
+    np.random.seed(0)
+    mol_geom = PyCESim.read_xyz(fname)
+    geom_pool = PyCESim.StartingConditions(mol_geom)
+    if channel_list:
+        geom_pool.set_channel_list(channel_list)
+    geom_pool.generate_pool(n_sims, sigma=np.full(mol_geom.natoms, sigma))
+    CE_sim = PyCESim.CESim(geom_pool)
+    CE_sim.make_timebins(t_range_list, n_step_list)
+    return(CE_sim)
+
+
+def benchmark(name, CE_sim):
+    CE_sim.run_sims(rtol=1e-10, atol=1e-10, units='natural')
+    v_ref = CE_sim.output_arr[:, :3].copy()
+    print(f'\n{name}')
+    print(f"{'units':>8} {'tol':>6} {'nfev':>8} {'time (s)':>9} {'rel. error':>11}")
+    for units in ['SI', 'natural']:
+        best = None
+        for tol in tol_list:
+            t0 = time.perf_counter()
+            CE_sim.run_sims(rtol=tol, atol=tol, units=units, save_all=True)
+            wall_time = time.perf_counter() - t0
+            nfev = np.mean([solution.nfev for solution in CE_sim.solution_list])
+            error = np.max(np.abs(CE_sim.output_arr[:, :3] - v_ref))/np.max(np.abs(v_ref))
+            print(f'{units:>8} {tol:6.0e} {nfev:8.1f} {wall_time:9.3f} {error:11.2e}')
+            if best is None and error < target_error:
+                best = (tol, nfev, wall_time)
+        if best:
+            print(f'{units:>8}: error < {target_error:.0e} at tol={best[0]:.0e}, '
+                  f'nfev={best[1]:.1f}, time={best[2]:.3f} s')
+
+
+if __name__ == '__main__':
+    channel_list = [PyCESim.CEChannel([1, 1, 1, 1, 1], 0.5), PyCESim.CEChannel([2, 1, 2, 1, 1], 0.5)]
+    CE_sim = make_sim('CH2O2.xyz', 50, channel_list, 0.1,
+                      [(0, 100e-15), (101e-15, 500e-15), (501e-15, 5e-12), (5.001e-12, 500e-12)], [50]*4)
+    benchmark('CH2O2, 50 simulations, 500 ps', CE_sim)
+
+    CE_sim = make_sim('HE10e3_0p027', 2, None, 0.3, [(0, 100e-15), (101e-15, 2e-12)], [50]*2)
+    benchmark('HE10e3, 2 simulations, 2 ps', CE_sim)
@@ -2,9 +2,18 @@ import numpy as np
 import pandas as pd
 import cclib
 import matplotlib.pyplot as plt
+import os
+import json
+import time
+import warnings
+import concurrent.futures
 from scipy.integrate import solve_ivp
 import scipy
 from scipy.special import laguerre
+import scipy.integrate
+import scipy.optimize
+import scipy.spatial
+import scipy.stats
 
 
 ### Constants
@@ -254,25 +263,36 @@ def read_log(log_file):
 
 
 
-def random_rotation(r_list):
+def random_rotation(r_list, rng=None):
     """
     Randomly rotate a list of vectors. See https://math.stackexchange.com/questions/442418/random-generation-of-rotation-matrices
 
     :param r_list: list of vector arrays.
+    :param rng: np.random.Generator used to draw the rotation (default the global np.random state)
 
 
     :return: list of ranomdly rotated vector arrays.
     """
 
     
-    r_list_rot = []
-    rm = rand_rotation_matrix()
-    for r in r_list:
-        r_list_rot.append(np.dot(rm,r))
-    return(r_list_rot)
+    rm = rand_rotation_matrix(rng=rng)
+    return(list(np.asarray(r_list) @ rm.T))
 
 
-def rand_rotation_matrix(deflection=1.0, randnums=None):
+def make_rng(seed, block=None):
+    """Random number generator for sampling, seeded from np.random.SeedSequence(seed). Blocks of a pool each get
+    their own independent stream, the block-th child spawned from the seed (SeedSequence(seed).spawn), so a pool
+    sampled block by block is the same however the blocks are spread over processes.
+
+    :param seed: integer seed
+    :param block: optional block number
+
+    :return: np.random.Generator"""
+    spawn_key = () if block is None else (block,)
+    return(np.random.default_rng(np.random.SeedSequence(seed, spawn_key=spawn_key)))
+
+
+def rand_rotation_matrix(deflection=1.0, randnums=None, rng=None):
     
     """
     Creates a random rotation matrix. See http://blog.lostinmyterminal.com/python/2015/05/12/random-rotation-matrix.html
@@ -281,13 +301,15 @@ def rand_rotation_matrix(deflection=1.0, randnums=None):
     :param deflection: the magnitude of the rotation. For 0, no rotation; for 1, competely random
     rotation. Small deflection => small perturbation.
     :param randnums: 3 random numbers in the range [0, 1]. If `None`, they will be auto-generated.
+    :param rng: np.random.Generator used to generate randnums (default the global np.random state)
 
     :return: random rotation matrix
     
     """
     
     if randnums is None:
-        randnums = np.random.uniform(size=(3,))
+        rng = np.random if rng is None else rng
+        randnums = rng.uniform(size=(3,))
         
     theta, phi, z = randnums
     
@@ -319,6 +341,120 @@ def rand_rotation_matrix(deflection=1.0, randnums=None):
     return M
 
 
+def rand_rotation_matrices(n, deflection=1.0, randnums=None, rng=None):
+    """Create a stack of random rotation matrices at once, with the same method as rand_rotation_matrix.
+
+    :param n: number of matrices
+    :param deflection: the magnitude of the rotation. For 0, no rotation; for 1, competely random rotation
+    :param randnums: (n,3) array of random numbers in the range [0, 1]. If `None`, they will be auto-generated.
+    :param rng: np.random.Generator used to generate randnums (default the global np.random state)
+
+    :return: (n,3,3) array of rotation matrices"""
+    if randnums is None:
+        rng = np.random if rng is None else rng
+        randnums = rng.uniform(size=(n, 3))
+    theta = randnums[:, 0] * 2.0*deflection*np.pi
+    phi = randnums[:, 1] * 2.0*np.pi
+    z = randnums[:, 2] * 2.0*deflection
+
+    r = np.sqrt(z)
+    V = np.stack((np.sin(phi) * r, np.cos(phi) * r, np.sqrt(2.0 - z)), axis=1)
+    st = np.sin(theta)
+    ct = np.cos(theta)
+    R = np.zeros((n, 3, 3))
+    R[:, 0, 0] = ct
+    R[:, 0, 1] = st
+    R[:, 1, 0] = -st
+    R[:, 1, 1] = ct
+    R[:, 2, 2] = 1
+
+    # ( V Transpose(V) - I ) R for each matrix
+    return(np.einsum('sij,sjk->sik', V[:, :, None]*V[:, None, :] - np.eye(3), R))
+
+
+def rand_quaternions(n, randnums=None, rng=None):
+    """Create uniformly distributed random unit quaternions (Shoemake's method), i.e. uniform random rotations.
+    The map from the unit cube is volume preserving, so evenly spread randnums give evenly spread rotations.
+
+    :param n: number of quaternions
+    :param randnums: (n,3) array of random numbers in the range [0, 1]. If `None`, they will be auto-generated.
+    :param rng: np.random.Generator used to generate randnums (default the global np.random state)
+
+    :return: (n,4) array of unit quaternions (w,x,y,z)"""
+    if randnums is None:
+        rng = np.random if rng is None else rng
+        randnums = rng.uniform(size=(n, 3))
+    u1, u2, u3 = randnums[:, 0], 2*np.pi*randnums[:, 1], 2*np.pi*randnums[:, 2]
+    a = np.sqrt(1-u1)
+    b = np.sqrt(u1)
+    return(np.stack((b*np.cos(u3), a*np.sin(u2), a*np.cos(u2), b*np.sin(u3)), axis=1))
+
+
+def quaternions_to_matrices(quaternions):
+    """Convert unit quaternions to rotation matrices.
+
+    :param quaternions: (n,4) array of unit quaternions (w,x,y,z)
+
+    :return: (n,3,3) array of rotation matrices"""
+    w, x, y, z = np.asarray(quaternions, dtype=float).T
+    return(np.stack((np.stack((1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y)), axis=1),
+                     np.stack((2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x)), axis=1),
+                     np.stack((2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)), axis=1)), axis=1))
+
+
+rotation_method_list = ['arvo', 'quaternion', 'sobol', 'halton']
+
+
+def rotation_matrices(n, method='arvo', rng=None):
+    """Create a set of uniform random rotations at once.
+
+    :param n: number of rotations
+    :param method: ['arvo', 'quaternion', 'sobol', 'halton']. 'arvo' uses rand_rotation_matrices, 'quaternion'
+    rand_quaternions. 'sobol' and 'halton' map a scrambled low-discrepancy sequence (scipy.stats.qmc) through
+    rand_quaternions, which covers the orientations more evenly than independent draws, so orientation averages
+    converge faster. Sobol sets only keep their balance properties for n a power of 2 (e.g. a pool chunk_size of
+    1024), other n are still low-discrepancy but less evenly spread
+    :param rng: np.random.Generator (default the global np.random state)
+
+    :return: (n,3,3) array of rotation matrices"""
+    if method not in rotation_method_list:
+        raise ValueError(f"Unknown rotation method {method}. Options are: {rotation_method_list}")
+    if method=='arvo':
+        return(rand_rotation_matrices(n, rng=rng))
+    if method=='quaternion':
+        return(quaternions_to_matrices(rand_quaternions(n, rng=rng)))
+    rng = np.random if rng is None else rng
+    if not isinstance(rng, np.random.Generator):
+        rng = np.random.default_rng(rng.randint(2**31))
+    engine = {'sobol': scipy.stats.qmc.Sobol, 'halton': scipy.stats.qmc.Halton}[method](d=3, seed=rng)
+    with warnings.catch_warnings():
+        # scipy warns for every Sobol draw of n not a power of 2, which is documented above instead
+        warnings.filterwarnings('ignore', message='The balance properties of Sobol', category=UserWarning)
+        randnums = engine.random(n)
+    return(quaternions_to_matrices(rand_quaternions(n, randnums=randnums)))
+
+
+def rotate_coordinates(coords, matrices):
+    """Rotate blocks of vectors, each by its own rotation matrix, in one operation.
+
+    :param coords: (n,natoms,3) array of vectors
+    :param matrices: (n,3,3) array of rotation matrices
+
+    :return: (n,natoms,3) array of rotated vectors"""
+    return(np.einsum('sij,saj->sai', matrices, coords))
+
+
+def rotate_states(y, matrices):
+    """Rotate the positions and velocities of a set of states, each by its own rotation matrix.
+
+    :param y: (n,natoms*6) array of states, in the layout of y in newton_equations (positions then velocities)
+    :param matrices: (n,3,3) array of rotation matrices
+
+    :return: (n,natoms*6) array of rotated states"""
+    n = len(y)
+    return(rotate_coordinates(np.asarray(y).reshape(n, -1, 3), matrices).reshape(n, -1))
+
+
 def coulomb_force(r1,r2,q1,q2):
     """Calculate Coulomb force between two charges in SI units.
 
@@ -337,6 +473,223 @@ def coulomb_force(r1,r2,q1,q2):
     return(k*q1*q2*r12*(1/r12_mag**3))
 
 
+def coulomb_forces(positions, charges, block_size=256, coulomb_k=k):
+    """Calculate the net Coulomb force on every charge by vectorized direct summation.
+    Each pair is evaluated once and applied to both charges (Newton's third law).
+    Pairs are processed in blocks of rows, with the k*q_i*q_j of each block made from the charges as it is
+    needed, so memory use stays at block_size*natoms.
+
+    :param positions: (natoms,3) array of positions
+    :param charges: array of charges (in units consistent with positions and coulomb_k)
+    :param block_size: number of rows of the pair matrix handled at once (default 256)
+    :param coulomb_k: Coulomb constant, for units other than SI (default k)
+
+    :return: (natoms,3) array of forces"""
+    n_atoms = len(positions)
+    forces = np.zeros_like(positions)
+    for start in range(0, n_atoms, block_size):
+        stop = min(start+block_size, n_atoms)
+        r_ij = positions[start:stop, None, :] - positions[None, start:, :]
+        r2 = np.einsum('ijk,ijk->ij', r_ij, r_ij)
+        # only keep pairs with j>i, so each pair is only calculated once
+        upper = np.arange(start, n_atoms)[None, :] > np.arange(start, stop)[:, None]
+        inv_r3 = np.divide(1.0, r2*np.sqrt(r2), out=np.zeros_like(r2), where=upper)
+        kqq = coulomb_k*charges[start:stop, None]*charges[None, start:]
+        f_ij = r_ij*(kqq*inv_r3)[:, :, None]
+        forces[start:stop] += f_ij.sum(axis=1)
+        forces[start:] -= f_ij.sum(axis=0)
+    return(forces)
+
+def coulomb_forces_on(idx, positions, charges, block_size=256, coulomb_k=k):
+    """Calculate the net Coulomb force on a subset of charges by direct summation over all charges.
+
+    :param idx: indices of the charges to calculate the force on
+    :param positions: (natoms,3) array of positions (in m)
+    :param charges: array of charges (in C)
+    :param block_size: number of target charges handled at once (default 256)
+    :param coulomb_k: Coulomb constant, for units other than SI (default k)
+
+    :return: (len(idx),3) array of forces (in N)"""
+    idx = np.asarray(idx)
+    forces = np.zeros((len(idx), 3))
+    for start in range(0, len(idx), block_size):
+        block = idx[start:start+block_size]
+        r_ij = positions[block, None, :] - positions[None, :, :]
+        r2 = np.einsum('ijk,ijk->ij', r_ij, r_ij)
+        inv_r3 = np.divide(1.0, r2*np.sqrt(r2), out=np.zeros_like(r2), where=r2>0)
+        forces[start:start+block_size] = coulomb_k*charges[block, None]*np.einsum('ijk,ij->ik', r_ij, charges[None, :]*inv_r3)
+    return(forces)
+
+
+def morton_keys(positions, depth):
+    """Calculate Morton (z-order) keys of 3D positions, by interleaving the bits of the
+    integer coordinates within the bounding cube.
+
+    :param positions: (natoms,3) array of positions
+    :param depth: number of bits per dimension (max 21)
+
+    :return: array of uint64 keys. Shifting right by 3*(depth-level) gives the octree cell at that level"""
+    r_min = positions.min(axis=0)
+    extent = np.max(positions.max(axis=0)-r_min)
+    if extent==0:
+        extent = 1.0
+    n_cells = 2**depth
+    ijk = np.minimum(((positions-r_min)/extent*n_cells).astype(np.uint64), np.uint64(n_cells-1))
+    keys = np.zeros(len(positions), dtype=np.uint64)
+    for bit in range(depth):
+        for dim in range(3):
+            keys |= ((ijk[:, dim] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3*bit+2-dim)
+    return(keys)
+
+
+def expand_ranges(owners, lo, hi):
+    """Expand ranges [lo,hi) into flat index arrays (vectorized), e.g. to list all atoms of a set of cells.
+
+    :param owners: array labelling each range
+    :param lo: array of range starts
+    :param hi: array of range ends (exclusive)
+
+    :return: (owner of each index, index) arrays"""
+    counts = hi-lo
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts)-counts, counts)
+    return(np.repeat(owners, counts), np.repeat(lo, counts)+offsets)
+
+
+def accumulate_rows(arr, rows, values):
+    """Add values to rows of a (n,3) array, summing repeated rows (faster np.add.at)."""
+    for dim in range(arr.shape[1]):
+        arr[:, dim] += np.bincount(rows, weights=values[:, dim], minlength=len(arr))
+
+
+def chebyshev_nodes(order):
+    """Chebyshev nodes (of the first kind) on [-1,1].
+
+    :param order: number of nodes
+
+    :return: array of nodes"""
+    return(np.cos((2*np.arange(order)+1)*np.pi/(2*order)))
+
+
+def chebyshev_weights(order, x, derivative=False):
+    """Chebyshev interpolation weights S(x_m, x) = 1/p + 2/p sum_k T_k(x_m) T_k(x), for the
+    order (p) Chebyshev nodes x_m and a set of points x in [-1,1].
+
+    :param order: number of Chebyshev nodes
+    :param x: array of points
+    :param derivative: if True, return the derivative of the weights with respect to x
+
+    :return: (len(x),order) array of weights"""
+    x = np.clip(x, -1, 1)
+    nodes = chebyshev_nodes(order)
+    # T_k at the nodes, and T_k (or dT_k/dx = k*U_{k-1}) at x, from the recurrence relations
+    t_nodes = np.cos(np.arange(order)[None, :]*np.arccos(nodes)[:, None])
+    t_x = np.zeros((len(x), order))
+    t_x[:, 0] = 1
+    if order>1:
+        t_x[:, 1] = x
+    for kk in range(2, order):
+        t_x[:, kk] = 2*x*t_x[:, kk-1] - t_x[:, kk-2]
+    if derivative:
+        u_x = np.zeros((len(x), order))
+        u_x[:, 0] = 1
+        if order>1:
+            u_x[:, 1] = 2*x
+        for kk in range(2, order):
+            u_x[:, kk] = 2*x*u_x[:, kk-1] - u_x[:, kk-2]
+        dt_x = np.zeros((len(x), order))
+        dt_x[:, 1:] = np.arange(1, order)*u_x[:, :-1]
+        return(2/order*dt_x[:, 1:] @ t_nodes[:, 1:].T)
+    return(1/order + 2/order*t_x[:, 1:] @ t_nodes[:, 1:].T)
+
+
+# Dormand-Prince 5(4) coefficients, as used by scipy.integrate.RK45
+rk45_c = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+rk45_a = np.array([[0, 0, 0, 0, 0],
+                   [1/5, 0, 0, 0, 0],
+                   [3/40, 9/40, 0, 0, 0],
+                   [44/45, -56/15, 32/9, 0, 0],
+                   [19372/6561, -25360/2187, 64448/6561, -212/729, 0],
+                   [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]])
+rk45_b = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+rk45_e = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+
+
+def rk45_batched(fun, y0, t_end, rtol=1e-3, atol=1e-6, max_iter=1000000):
+    """Integrate a batch of independent ODE systems from t=0 to t_end with the Dormand-Prince RK45
+    method, using the same step size control as scipy.integrate.RK45 but with a separate step size
+    (and accept/reject decision) for each system. All unfinished systems are advanced together,
+    so fun is evaluated once per stage for the whole batch.
+
+    :param fun: function fun(t, y, idx) returning dy/dt for the systems idx, where t is an array of
+    times and y a (len(idx),n) array of states
+    :param y0: (n_systems,n) array of initial states
+    :param t_end: final time
+    :param rtol: relative tolerance (default 1e-3, as solve_ivp)
+    :param atol: absolute tolerance (default 1e-6, as solve_ivp)
+    :param max_iter: max number of (batched) steps
+
+    :return: ((n_systems,n) array of final states, array of the number of function evaluations per system)"""
+    y = np.array(y0, dtype=float)
+    n_systems = len(y)
+    idx_all = np.arange(n_systems)
+    t = np.zeros(n_systems)
+    nfev = np.zeros(n_systems, dtype=int)
+    rejected = np.zeros(n_systems, dtype=bool)
+
+    def rms(x):
+        return(np.sqrt(np.mean(x**2, axis=1)))
+
+    # initial step size, as scipy.integrate._ivp.common.select_initial_step
+    f = fun(t, y, idx_all)
+    scale = atol + np.abs(y)*rtol
+    d0 = rms(y/scale)
+    d1 = rms(f/scale)
+    h0 = np.where((d0<1e-5) | (d1<1e-5), 1e-6, 0.01*d0/np.where(d1>0, d1, 1))
+    h0 = np.minimum(h0, t_end)
+    f1 = fun(t+h0, y+h0[:, None]*f, idx_all)
+    d2 = rms((f1-f)/scale)/h0
+    d12 = np.maximum(d1, d2)
+    h1 = np.where(d12<=1e-15, np.maximum(1e-6, h0*1e-3), (0.01/np.where(d12>0, d12, 1))**(1/5))
+    h = np.minimum(100*h0, h1)
+    nfev += 2
+
+    for _ in range(max_iter):
+        active = np.flatnonzero(t<t_end)
+        if not len(active):
+            break
+        ya = y[active]
+        ta = t[active]
+        ha = np.minimum(h[active], t_end-ta)
+        stages = np.zeros((7,) + ya.shape)
+        stages[0] = f[active]
+        for s in range(1, 6):
+            dy = np.einsum('s,sij->ij', rk45_a[s, :s], stages[:s])*ha[:, None]
+            stages[s] = fun(ta+rk45_c[s]*ha, ya+dy, active)
+        y_new = ya + np.einsum('s,sij->ij', rk45_b, stages[:6])*ha[:, None]
+        t_new = np.where(ta+ha>=t_end, t_end, ta+ha)
+        stages[6] = fun(t_new, y_new, active)
+        nfev[active] += 6
+
+        scale = atol + np.maximum(np.abs(ya), np.abs(y_new))*rtol
+        err_norm = rms(np.einsum('s,sij->ij', rk45_e, stages)*ha[:, None]/scale)
+        accepted = err_norm<1
+        with np.errstate(divide='ignore'):
+            factor = np.where(err_norm==0, 10, 0.9*err_norm**(-1/5))
+        # as scipy: grow by at most 10 after an accepted step (not at all if the step was just rejected),
+        # shrink by at most 5 after a rejected one
+        grow = np.where(rejected[active], np.minimum(1, factor), np.minimum(10, factor))
+        h[active] = ha*np.where(accepted, grow, np.maximum(0.2, factor))
+        rejected[active] = ~accepted
+
+        acc = active[accepted]
+        y[acc] = y_new[accepted]
+        t[acc] = t_new[accepted]
+        f[acc] = stages[6][accepted]
+    else:
+        print(f'WARNING: batched integration did not reach t={t_end} within {max_iter} steps')
+    return(y, nfev)
+
+
 def calc_W(P,Q,n=0):
     """Calculate unitless Wigner function.
 
@@ -344,16 +697,132 @@ def calc_W(P,Q,n=0):
     :param Q: unitless position
     :param n: vibrational state (0 by default)
 
-    :return: W(P,Q,n)"""
-    if n>0:
-        Ln = scipy.special.laguerre(0)
-        rhosquare = 2.0 * (P**2 + Q**2)
-        Ln = scipy.special.laguerre(n)
-        W = (-1.0)**n * Ln(rhosquare) * np.exp(-rhosquare / 2.0)
-    else:
-        W = np.exp(-Q**2)*np.exp(-P**2)
+    :return: W(P,Q,n). P, Q and n can also be arrays"""
+    rhosquare = 2.0 * (P**2 + Q**2)
+    W = (-1.0)**n * scipy.special.eval_laguerre(n, rhosquare) * np.exp(-rhosquare / 2.0)
     return(W)
 
+
+def sample_wigner(n_states, wigner_sample_max=3, rng=None):
+    """Sample unitless (P,Q) from the Wigner function (see calc_W) of each given vibrational state, all at once,
+    within -wigner_sample_max < P,Q < wigner_sample_max. For n=0 the Wigner function is a Gaussian
+    exp(-P^2-Q^2), which is sampled directly. For n>0 the positive part of the Wigner function is sampled by
+    rejection, with one vectorized batch of proposals for all the samples not yet accepted.
+
+    :param n_states: array of vibrational states
+    :param wigner_sample_max: the max (absolute) value of P and Q (default 3)
+    :param rng: np.random.Generator (default the global np.random state)
+
+    :return: (P, Q) arrays, with the shape of n_states"""
+    rng = np.random if rng is None else rng
+    n_states = np.asarray(n_states)
+    P = np.zeros(n_states.shape)
+    Q = np.zeros(n_states.shape)
+    todo = np.nonzero(n_states.ravel()==0)[0]
+    while len(todo):
+        P.ravel()[todo] = rng.normal(scale=np.sqrt(0.5), size=len(todo))
+        Q.ravel()[todo] = rng.normal(scale=np.sqrt(0.5), size=len(todo))
+        todo = todo[(np.abs(P.ravel()[todo])>wigner_sample_max) | (np.abs(Q.ravel()[todo])>wigner_sample_max)]
+    todo = np.nonzero(n_states.ravel()>0)[0]
+    while len(todo):
+        random_P = rng.uniform(-wigner_sample_max, wigner_sample_max, size=len(todo))
+        random_Q = rng.uniform(-wigner_sample_max, wigner_sample_max, size=len(todo))
+        accepted = calc_W(random_P, random_Q, n=n_states.ravel()[todo]) > rng.uniform(0, 1, size=len(todo))
+        P.ravel()[todo[accepted]] = random_P[accepted]
+        Q.ravel()[todo[accepted]] = random_Q[accepted]
+        todo = todo[~accepted]
+    return(P, Q)
+
+class ThermalWignerTable:
+    """Precomputed tables for sampling vibrational states and Wigner distributions of a set of normal modes
+    at temperature T (see get_wigner_table, which caches them). The vibrational state of each mode is drawn
+    by inverse-CDF lookup in its cumulative thermal populations. Q is drawn by inverse-CDF lookup in the
+    tabulated marginal distribution of Q for each state, the positive part of the Wigner function (see calc_W)
+    integrated over P, within -wigner_sample_max < P,Q < wigner_sample_max, which is the distribution the
+    rejection sampler (sample_wigner) draws Q from. For n=0 this is a Gaussian, which is sampled directly.
+
+    :param omegas: array of vibrational frequencies (in wavenumbers)
+    :param T: temperature (in K)
+    :param nmax: max vibrational state considered
+    :param wigner_sample_max: the max (absolute) value of P and Q (default 3)
+    :param n_grid: number of grid points in P and Q for the tabulated distributions (default 1001)"""
+    def __init__(self, omegas, T, nmax, wigner_sample_max=3, n_grid=1001):
+        self.omegas = np.array(omegas, dtype=float)
+        self.T = T
+        self.nmax = nmax
+        self.wigner_sample_max = wigner_sample_max
+        if T>0:
+            self.Pn_arr = calc_Pn(self.omegas[:, None], T, np.arange(nmax)[None, :])
+        else:
+            self.Pn_arr = np.zeros((len(self.omegas), nmax))
+            self.Pn_arr[:, 0] = 1
+        self.Pn_cdf = np.cumsum(self.Pn_arr/np.sum(self.Pn_arr, axis=1, keepdims=True), axis=1)
+        self.grid = np.linspace(-wigner_sample_max, wigner_sample_max, n_grid)
+        self.Q_cdf = {}
+
+    def sample_states(self, n_samples, rng=None):
+        """Draw the vibrational state of each mode for n_samples samples.
+
+        :param n_samples: number of samples
+        :param rng: np.random.Generator (default the global np.random state)
+
+        :return: (n_samples,n_modes) array of states"""
+        rng = np.random if rng is None else rng
+        n_states = np.zeros((n_samples, len(self.omegas)), dtype=int)
+        if self.T>0:
+            random_u = rng.uniform(size=(n_samples, len(self.omegas)))
+            for mode, cdf in enumerate(self.Pn_cdf):
+                n_states[:, mode] = np.minimum(np.searchsorted(cdf, random_u[:, mode], side='right'), self.nmax-1)
+        return(n_states)
+
+    def get_Q_cdf(self, n):
+        """Cumulative distribution of Q for vibrational state n, on self.grid, tabulated on first use."""
+        if n not in self.Q_cdf:
+            W = np.maximum(calc_W(self.grid[None, :], self.grid[:, None], n=n), 0)
+            dP = np.diff(self.grid)
+            marginal = np.sum(0.5*(W[:, 1:]+W[:, :-1])*dP, axis=1)
+            cdf = np.concatenate(([0], np.cumsum(0.5*(marginal[1:]+marginal[:-1])*np.diff(self.grid))))
+            self.Q_cdf[n] = cdf/cdf[-1]
+        return(self.Q_cdf[n])
+
+    def sample_Q(self, n_states, rng=None):
+        """Draw Q for each given vibrational state.
+
+        :param n_states: array of vibrational states
+        :param rng: np.random.Generator (default the global np.random state)
+
+        :return: array of Q, with the shape of n_states"""
+        rng = np.random if rng is None else rng
+        n_states = np.asarray(n_states)
+        Q = np.zeros(n_states.shape)
+        ground = n_states==0
+        Q[ground] = sample_wigner(np.zeros(np.sum(ground), dtype=int), self.wigner_sample_max, rng=rng)[1]
+        for n in np.unique(n_states[~ground]):
+            excited = n_states==n
+            Q[excited] = np.interp(rng.uniform(size=np.sum(excited)), self.get_Q_cdf(n), self.grid)
+        return(Q)
+
+
+# ThermalWignerTable objects, keyed by (frequencies, T, nmax, wigner_sample_max), see get_wigner_table
+wigner_table_cache = {}
+
+
+def get_wigner_table(omegas, T, nmax, wigner_sample_max=3):
+    """Get the thermal Wigner sampling table (see ThermalWignerTable) for a set of normal modes,
+    from the cache if a pool was generated with the same frequencies, T, nmax and wigner_sample_max before.
+
+    :param omegas: array of vibrational frequencies (in wavenumbers)
+    :param T: temperature (in K)
+    :param nmax: max vibrational state considered
+    :param wigner_sample_max: the max (absolute) value of P and Q (default 3)
+
+    :return: ThermalWignerTable"""
+    key = (tuple(np.round(np.asarray(omegas, dtype=float), 6)), float(T), int(nmax), float(wigner_sample_max))
+    if key not in wigner_table_cache:
+        wigner_table_cache[key] = ThermalWignerTable(omegas, T, nmax, wigner_sample_max=wigner_sample_max)
+    return(wigner_table_cache[key])
+
+
 def calc_canonical_partition(omega, T):
     """Calculate vibrational canonical partition function.
 
@@ -548,14 +1017,125 @@ class CEChannel:
             self.label=label
 
 
+class ChargeStateModel:
+    """Model of the charge state of each atom, drawn independently for every atom of every sample, instead of
+    enumerating the charges of every atom in CEChannels (see StartingConditions.set_charge_model). Intended for
+    large clusters, where the number of possible channels is astronomical. The probabilities of the charge states
+    can be the same for all atoms (p), depend on the element (element_p, for the elements it includes), or depend on
+    the distance of the atom from the centre of mass in each sampled geometry (radius_edges and radius_p), which
+    takes precedence over both.
+
+    :param charge_states: list of possible charges (in units of e), e.g. [0, 1, 2]
+    :param p: probability of each charge state, for all atoms
+    :param element_p: optional dict of the probability of each charge state for each element, e.g. {'He': [0.2, 0.7, 0.1]}
+    :param radius_edges: optional (n_bins+1) array of the edges of bins of distance from the centre of mass (in angstrom).
+    Atoms outside the edges are counted in the first or last bin
+    :param radius_p: (n_bins,len(charge_states)) array of the probability of each charge state in each bin"""
+    def __init__(self, charge_states, p=None, element_p=None, radius_edges=None, radius_p=None):
+        self.charge_states = np.array(charge_states, dtype=np.int8)
+        self.p = None if p is None else self.normalise(p)
+        self.element_p = {} if element_p is None else {element: self.normalise(element_p[element])
+                                                       for element in element_p}
+        self.radius_edges = None if radius_edges is None else np.array(radius_edges, dtype=float)
+        self.radius_p = None if radius_p is None else self.normalise(radius_p)
+        if (self.radius_edges is None)!=(self.radius_p is None):
+            raise ValueError("radius_edges and radius_p must be given together")
+        if self.radius_p is not None and len(self.radius_p)!=len(self.radius_edges)-1:
+            raise ValueError(f"radius_p should have one row per radius bin ({len(self.radius_edges)-1})")
+        if self.p is None and not self.element_p and self.radius_p is None:
+            raise ValueError("Give the charge state probabilities with p, element_p or radius_p")
+
+    def normalise(self, p):
+        """Check an array of charge state probabilities (last axis) and rescale it to sum to 1."""
+        p = np.array(p, dtype=float)
+        if p.shape[-1]!=len(self.charge_states) or np.any(p<0):
+            raise ValueError(f"Charge state probabilities should be {len(self.charge_states)} numbers >=0 "
+                             f"(one per charge state)")
+        return(p/np.sum(p, axis=-1, keepdims=True))
+
+    @property
+    def settings(self):
+        """Parameters of the model, as stored in pool.json (see StartingConditions.save_pool)."""
+        return({'charge_states': self.charge_states.tolist(), 'p': None if self.p is None else self.p.tolist(),
+                'element_p': {element: p.tolist() for element, p in self.element_p.items()},
+                'radius_edges': None if self.radius_edges is None else self.radius_edges.tolist(),
+                'radius_p': None if self.radius_p is None else self.radius_p.tolist()})
+
+    def atom_p(self, element_list):
+        """Probability of each charge state for each atom, from p and element_p.
+
+        :param element_list: list of the element of each atom
+
+        :return: (natoms,len(charge_states)) array"""
+        atom_p = []
+        for element in element_list:
+            if element in self.element_p:
+                atom_p.append(self.element_p[element])
+            elif self.p is not None:
+                atom_p.append(self.p)
+            else:
+                raise ValueError(f"No charge state probabilities for element {element}")
+        return(np.array(atom_p))
+
+    def sample(self, positions, element_list, rng=None):
+        """Draw the charge of every atom of every sample at once, by inverse-CDF lookup.
+
+        :param positions: (n_samples,natoms,3) array of positions (in m), relative to the centre of mass
+        :param element_list: list of the element of each atom
+        :param rng: np.random.Generator (default the global np.random state)
+
+        :return: (n_samples,natoms) array of charges (in units of e)"""
+        rng = np.random if rng is None else rng
+        if self.radius_p is not None:
+            radius = np.linalg.norm(positions, axis=2)*1e10
+            radius_bin = np.clip(np.searchsorted(self.radius_edges, radius, side='right')-1, 0, len(self.radius_p)-1)
+            cdf = np.cumsum(self.radius_p, axis=1)[radius_bin]
+        else:
+            cdf = np.cumsum(self.atom_p(element_list), axis=1)[None]
+        random_u = rng.uniform(size=positions.shape[:2])
+        state_idx = np.zeros(positions.shape[:2], dtype=np.intp)
+        for state in range(len(self.charge_states)-1):
+            state_idx += random_u>=cdf[..., state]
+        return(self.charge_states[state_idx])
+
+
+# arrays of a pool of starting conditions and the .npy files they are stored in (see StartingConditions.save_pool)
+pool_file_dict = {'samp_y0_list': 'y0.npy',
+                  'samp_channel_idx': 'channel_idx.npy',
+                  'samp_charge_arr': 'charges.npy',
+                  'samp_n_arr': 'wigner_n.npy',
+                  'samp_q_arr': 'wigner_q.npy'}
+
+
 class StartingConditions:
     """Class for generating starting conditions for CE simulation.
 
+    The pool is stored as arrays: the initial states (self.samp_y0_list, (n_geoms,natoms*6)), the channel
+    index of each sample (self.samp_channel_idx), with a charge model the charge of each atom of each sample
+    (self.samp_charge_arr, (n_geoms,natoms), in units of e) and, for Wigner sampling, the vibrational state and Q of
+    each sample and mode (self.samp_n_arr and self.samp_q_arr, (n_geoms,n_modes)). If generated with a
+    pool_path, or reopened with open_pool, these arrays are memory-mapped .npy files (see pool_file_dict).
+
     :param eq_geometry: (equilibrium) geometry"""
     
     def __init__(self, eq_geometry):
         self.eq_geometry = eq_geometry
         self.multi_channel=False
+        self.charge_model = None
+        self.pool_path = None
+
+    def __getstate__(self):
+        # a memory-mapped pool is pickled as its path, and reopened read-only
+        state = self.__dict__.copy()
+        if self.pool_path is not None:
+            for name in pool_file_dict:
+                state.pop(name, None)
+        return(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.pool_path is not None:
+            self.load_pool_arrays(self.pool_path, mode='r')
 
     def set_channel_list(self, channel_list):
         """Add a list of different channels to the object
@@ -576,6 +1156,78 @@ class StartingConditions:
         for i, channel in enumerate(self.channel_list):
             channel.index=i
 
+    def set_charge_model(self, charge_model):
+        """Draw the charge of each atom of each sample from a ChargeStateModel, instead of a channel list.
+
+        :param charge_model: ChargeStateModel object, or None to go back to channels"""
+        self.charge_model = charge_model
+
+    def build_channel_cache(self):
+        """Precompute the per-channel tables used by the simulations, as (n_channels,natoms) arrays:
+        charges (self.channel_charges, in C) and masses (self.channel_masses, in kg).
+        Without a channel list there is a single channel with all charges +1. The channel indices of the samples
+        are stored in the smallest unsigned integer type that holds them (self.channel_idx_dtype)."""
+        natoms = self.eq_geometry.natoms
+        if self.multi_channel:
+            self.channel_charges = np.array([channel.charges*e for channel in self.channel_list], dtype=float)
+        else:
+            self.channel_charges = np.ones((1, natoms))*e
+        self.channel_masses = np.tile(np.array(self.eq_geometry.atom_masses, dtype=float)*u,
+                                      (len(self.channel_charges), 1))
+        self.channel_idx_dtype = np.min_scalar_type(len(self.channel_charges)-1)
+
+    def sample_charges(self, idx):
+        """Charges (in C) of a sample (or (n,natoms) for an array of samples), from the charge model or the channel.
+
+        :param idx: sample number, or array of sample numbers"""
+        if self.charge_model is not None:
+            return(self.samp_charge_arr[idx]*e)
+        return(self.channel_charges[self.samp_channel_idx[idx]])
+
+    @property
+    def samp_charges_list(self):
+        """Charges (in C) of each sample, as views of the per-channel table (or from self.samp_charge_arr
+        with a charge model)."""
+        if self.charge_model is not None:
+            return(list(self.samp_charge_arr*e))
+        return([self.channel_charges[i] for i in self.samp_channel_idx])
+
+    @property
+    def samp_masses_list(self):
+        """Masses (in kg) of each sample, as views of the per-channel table."""
+        return([self.channel_masses[i] for i in self.samp_channel_idx])
+
+    @property
+    def samp_channel_list(self):
+        """CEChannel of each sample (empty if no channels were set)."""
+        if not self.multi_channel:
+            return([])
+        return([self.channel_list[i] for i in self.samp_channel_idx])
+
+    @property
+    def samp_n_list(self):
+        """Vibrational state of each sample and mode (Wigner sampling), flattened."""
+        return(self.samp_n_arr.ravel())
+
+    @property
+    def samp_q_list(self):
+        """Q of each sample and mode (Wigner sampling), flattened."""
+        return(self.samp_q_arr.ravel())
+
+    def pool_array(self, name, shape, dtype=float):
+        """Allocate an array of the pool, filled with zeros: a memory-mapped .npy file in self.pool_path
+        if set, otherwise in memory.
+
+        :param name: attribute name of the array (a key of pool_file_dict)
+        :param shape: shape of the array
+        :param dtype: data type (default float)
+
+        :return: array"""
+        if self.pool_path is None:
+            return(np.zeros(shape, dtype=dtype))
+        return(np.lib.format.open_memmap(os.path.join(self.pool_path, pool_file_dict[name]), mode='w+',
+                                         dtype=dtype, shape=shape))
+
     def sigma_to_array(self):
         """Convert sigma from single number to 1 element array if needed."""
         # First check if sigma is a single number, convert to single number array if so
@@ -583,21 +1235,141 @@ class StartingConditions:
             self.sigma = np.array([self.sigma])
             
 
-    def generate_pool(self, n_geoms, method='gaussian',random_rotate=True, sigma=0.1, wigner_sample_max=3, T=0, nmax=5):
+    def generate_pool(self, n_geoms, method='gaussian',random_rotate=True, sigma=0.1, wigner_sample_max=3, T=0, nmax=5,
+                      pool_path=None, chunk_size=None, seed=None, n_workers=None, rotation_method='arvo'):
         """Main method for generating the pool of starting conditions for simulation.
 
         :param n_geoms: number of samples in the pool
         :param method: ['gaussian', 'wigner'] method of blurring geometries. If 'gaussian', geometries are just convolved
         by a Gaussian distribution of width sigma. If 'wigner', instead sample from vibrational wigner distribution
         with a specified temeprature. This requires the geometry to include normal modes as appropriate.
-        :param sigma: sigma for Gaussian convolution
+        :param sigma: sigma for Gaussian convolution (in angstrom): a single number, one per atom ((natoms,) array),
+        one per axis ((3,) array) or one per atom and axis ((natoms,3) array). For a triatomic a (3,) array would
+        be ambiguous, so give a (natoms,3) array instead
         :param random_rotate: if True, randomly rotate each sampled geometry
         :param wigner_sample_max: the max (absolute) value of P and Q used for Wigner sampling
         :param T: temperature for wigner sampling
         :param nmax: max vibrational state considered for wigner sampling
+        :param pool_path: if given, the pool is written to memory-mapped .npy files in this directory, and can be
+        reopened later with open_pool
+        :param chunk_size: number of geometries sampled at once (default all, or 1000 with a seed). Limits the memory
+        used for large pools, but changes the random number stream
+        :param seed: if given, sample each chunk of the pool from its own random number stream spawned from this
+        seed (see make_rng), instead of the global np.random state. The same seed and chunk_size always give the same
+        pool, also with stream_pool, whatever n_workers is
+        :param n_workers: if >1, sample the chunks in this many processes (needs a seed)
+        :param rotation_method: ['arvo', 'quaternion', 'sobol', 'halton'] sampler of the random rotations
+        (see rotation_matrices). 'sobol' and 'halton' give low-discrepancy orientation sets within each chunk
 
         """
+        if n_workers and n_workers>1 and seed is None:
+            raise ValueError("Sampling a pool in parallel needs a seed, so the processes draw independent streams")
+        self.setup_pool(n_geoms, method=method, random_rotate=random_rotate, sigma=sigma,
+                        wigner_sample_max=wigner_sample_max, T=T, nmax=nmax, rotation_method=rotation_method)
+        self.pool_path = pool_path
+        if pool_path is not None:
+            os.makedirs(pool_path, exist_ok=True)
+        natoms = self.eq_geometry.natoms
+        self.samp_channel_idx = self.pool_array('samp_channel_idx', (self.n_geoms,), self.channel_idx_dtype)
+        if self.method=='wigner':
+            n_modes = len(self.eq_geometry.omegas)
+            self.samp_n_arr = self.pool_array('samp_n_arr', (self.n_geoms, n_modes), np.int16)
+            self.samp_q_arr = self.pool_array('samp_q_arr', (self.n_geoms, n_modes))
+        if self.charge_model is not None:
+            self.samp_charge_arr = self.pool_array('samp_charge_arr', (self.n_geoms, natoms), np.int8)
+
+        # the pool is one preallocated (n_geoms,natoms*6) array, with zero initial velocities
+        self.samp_y0_list = self.pool_array('samp_y0_list', (self.n_geoms, 6*natoms))
+        if chunk_size is None:
+            # max(1, ...) so an empty pool gives no blocks instead of a zero range step
+            chunk_size = max(1, self.n_geoms) if seed is None else 1000
+        blocks = [(start, min(start+chunk_size, self.n_geoms)) for start in range(0, self.n_geoms, chunk_size)]
+        for (start, stop), (y0, channel_idx, n_states, random_Q, charges) in zip(blocks,
+                                                                                 self.sample_blocks(blocks, seed, n_workers)):
+            self.samp_y0_list[start:stop] = y0
+            self.samp_channel_idx[start:stop] = channel_idx
+            if self.charge_model is not None:
+                self.samp_charge_arr[start:stop] = charges
+            if self.method=='wigner':
+                self.samp_n_arr[start:stop] = n_states
+                self.samp_q_arr[start:stop] = random_Q
+
+        if pool_path is not None:
+            self.save_pool(pool_path)
+
+    def stream_pool(self, n_geoms, chunk_size=1000, seed=None, method='gaussian', random_rotate=True, sigma=0.1,
+                    wigner_sample_max=3, T=0, nmax=5, rotation_method='arvo'):
+        """Generate starting conditions on demand, in chunks, instead of storing the whole pool. Pass the
+        generator to CESim.run_sims(stream=...), which integrates each chunk as soon as it is sampled, so the
+        memory used does not depend on n_geoms. The settings of the pool are replaced (as by generate_pool),
+        but the pool arrays (self.samp_y0_list etc.) are not changed.
+
+        :param n_geoms: number of samples
+        :param chunk_size: number of samples generated at once (default 1000)
+        :param seed: if given, sample each chunk from its own random number stream spawned from this seed
+        (see make_rng), so the same seed and chunk_size always stream the same samples, as generate_pool would give
+        :param method: ['gaussian', 'wigner'], see generate_pool
+        :param random_rotate: if True, randomly rotate each sampled geometry
+        :param sigma: sigma for Gaussian convolution (in angstrom), see generate_pool
+        :param wigner_sample_max: the max (absolute) value of P and Q used for Wigner sampling
+        :param T: temperature for wigner sampling
+        :param nmax: max vibrational state considered for wigner sampling
+        :param rotation_method: sampler of the random rotations (see rotation_matrices)
+
+        :return: generator of (index of the first sample, (n,natoms*6) array of initial states, (n,) array of
+        channel indices, (n,natoms) array of charges (in units of e) with a charge model, otherwise None) tuples"""
+        self.setup_pool(n_geoms, method=method, random_rotate=random_rotate, sigma=sigma,
+                        wigner_sample_max=wigner_sample_max, T=T, nmax=nmax, rotation_method=rotation_method)
+        return(self.iter_sample_chunks(n_geoms, chunk_size, seed))
+
+    def sample_blocks(self, blocks, seed=None, n_workers=None):
+        """Sample the blocks of a pool in order, each from its own random number stream if seeded (see make_rng),
+        in a pool of worker processes if n_workers>1.
+
+        :param blocks: list of (start, stop) sample ranges
+        :param seed: optional seed of the pool
+        :param n_workers: optional number of worker processes
+
+        :return: generator of the output of sample_chunk for each block"""
+        if n_workers and n_workers>1:
+            sampler = self.sampler_copy()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+                yield from executor.map(sample_pool_block, [sampler]*len(blocks),
+                                        [stop-start for start, stop in blocks], [seed]*len(blocks), range(len(blocks)))
+            return
+        for block, (start, stop) in enumerate(blocks):
+            yield(self.sample_chunk(stop-start, rng=None if seed is None else make_rng(seed, block)))
+
+    def iter_sample_chunks(self, n_geoms, chunk_size, seed=None):
+        """Generator behind stream_pool: each chunk is only sampled when the stream is consumed."""
+        for block, start in enumerate(range(0, n_geoms, chunk_size)):
+            rng = None if seed is None else make_rng(seed, block)
+            y0, channel_idx, n_states, random_Q, charges = self.sample_chunk(min(chunk_size, n_geoms-start), rng=rng)
+            yield(start, y0, channel_idx, charges)
+
+    def sampler_copy(self):
+        """Copy of this object with the settings and tables of the pool, but not its arrays, to send to
+        the processes sampling a pool in parallel."""
+        sampler = StartingConditions.__new__(StartingConditions)
+        sampler.__dict__ = {key: value for key, value in self.__dict__.items() if key not in pool_file_dict}
+        sampler.pool_path = None
+        return(sampler)
+
+    def setup_pool(self, n_geoms, method='gaussian', random_rotate=True, sigma=0.1, wigner_sample_max=3, T=0, nmax=5,
+                   rotation_method='arvo'):
+        """Store the settings of a pool and prepare the tables it is sampled from (channels and, for Wigner
+        sampling, the vibrational state populations). Used by generate_pool and stream_pool, see generate_pool
+        for the parameters."""
+        if method not in ['gaussian', 'wigner']:
+            raise ValueError(f"Unknown method {method}. Options are: ['gaussian', 'wigner']")
+        if rotation_method not in rotation_method_list:
+            raise ValueError(f"Unknown rotation method {rotation_method}. Options are: {rotation_method_list}")
+        if self.charge_model is not None and self.multi_channel:
+            raise ValueError("Use either a channel list or a charge model, not both")
+        if self.charge_model is not None and not hasattr(self.eq_geometry, 'element_list'):
+            raise ValueError("A charge model needs the element of each atom (eq_geometry.element_list)")
         self.method = method
+        self.rotation_method = rotation_method
         if self.method=='wigner':
             # If generating a pool of simulations by Wigner sampling, we need
             # the normal modes, their frequencies, and a temperature
@@ -606,7 +1378,6 @@ class StartingConditions:
             self.T = T
             expected_modes = 3*self.eq_geometry.natoms-6
             expected_modes2 = 3*self.eq_geometry.natoms-5
-            self.samp_q_list=[]
             
         self.n_geoms = n_geoms
         self.random_rotate=random_rotate
@@ -614,10 +1385,7 @@ class StartingConditions:
         self.wigner_sample_max=wigner_sample_max
         self.nmax=nmax
         
-        self.samp_y0_list = []
-        self.samp_charges_list = []
-        self.samp_masses_list = []
-        self.samp_channel_list = []
+        self.build_channel_cache()
         self.eq_geometry.com_geometry()
 
         if self.method=='gaussian':
@@ -627,92 +1395,171 @@ class StartingConditions:
             self.sigma_to_array()
 
         if self.method=='wigner':
-            if T>0:
-                # for positive temperature, need to calculate probability of populating excited vib states
-                self.n_list = list(range(self.nmax))
-                self.Pn_arr = np.zeros((len(self.eq_geometry.nmodes),nmax))
-                self.samp_n_list = []
-                for n in range(nmax):
-                    for i, omega in enumerate(self.eq_geometry.omegas):
-                        Pn = calc_Pn(omega,T,n)
-                        self.Pn_arr[i,n] = Pn
-        
-        for i in range(self.n_geoms):
-            y0 = np.zeros((self.eq_geometry.natoms*6))
-            r_list = []
-
-            if self.multi_channel:
-                channel = np.random.choice(self.channel_list,p=self.channel_p_list)
-                self.samp_channel_list.append(channel)
-                charges = channel.charges*e
-                masses = self.eq_geometry.atom_masses*u
-            else:
-                charges = np.ones(self.eq_geometry.natoms)*e
-                masses = self.eq_geometry.atom_masses*u
-
-                
+            # populations of the vibrational states and Wigner sampling tables, shared by all pools
+            # of the same geometry, temperature and nmax
+            self.n_list = list(range(self.nmax))
+            self.wigner_table = get_wigner_table(self.eq_geometry.omegas, T, nmax, wigner_sample_max)
+            self.Pn_arr = self.wigner_table.Pn_arr
+            # the displacements per unit Q only depend on the molecule, so they are made once per pool and
+            # shared by all its chunks (and copied to the sampling processes with the other settings)
+            self.mode_matrix = self.wigner_mode_matrix()
+
+    def sample_chunk(self, n_geoms, rng=None):
+        """Sample starting conditions with the settings of setup_pool: the channel of each sample, then
+        the geometries with zero initial velocities, then with a charge model the charge of each atom,
+        and the geometries are randomly rotated if self.random_rotate (positions and velocities, see rotate_states).
+
+        :param n_geoms: number of samples
+        :param rng: np.random.Generator (default the global np.random state)
+
+        :return: ((n_geoms,natoms*6) array of initial states, (n_geoms,) array of channel indices, for
+        Wigner sampling the (n_geoms,n_modes) arrays of vibrational states and Q, otherwise None, and with a charge
+        model the (n_geoms,natoms) array of charges (in units of e), otherwise None)"""
+        natoms = self.eq_geometry.natoms
+        rng = np.random if rng is None else rng
+        # the channels of all the samples are drawn at once, as indices into self.channel_list
+        if self.multi_channel:
+            samp_channel_idx = rng.choice(len(self.channel_list), size=n_geoms, p=self.channel_p_list)
+        else:
+            samp_channel_idx = np.zeros(n_geoms)
 
-            if self.method=='gaussian':
-                for n in range(self.eq_geometry.natoms):
-                        if np.shape(self.sigma)[0]==1:
-                            blur_sigma=self.sigma
-                        elif np.shape(self.sigma)[0]==self.eq_geometry.natoms:
-                            blur_sigma=self.sigma[n]
-    
-                        rs = np.array([(self.eq_geometry.atom_coords_com[n][0]+np.random.normal(loc=0,scale=blur_sigma))*1e-10,
-                                       (self.eq_geometry.atom_coords_com[n][1]+np.random.normal(loc=0,scale=blur_sigma))*1e-10,
-                                       (self.eq_geometry.atom_coords_com[n][2]+np.random.normal(loc=0,scale=blur_sigma))*1e-10])
-                        r_list.append(rs)
-                    
-            elif self.method=='wigner':
-                mode_counter=0
-                new_geom = self.eq_geometry.atom_coords_com.copy()
-                for nmode, omega in zip(self.eq_geometry.nmodes_weighted, self.eq_geometry.omegas):
-                    mode_freq_hartree = omega*cm_to_hartree
-                    freq_factor = np.sqrt(mode_freq_hartree)
-            
-                    wigner_sampled = False
-
-                    # chose vibrational state
-                    if T>0:
-                        Pn = self.Pn_arr[mode_counter,:].copy()
-                        Pn_scaled = Pn/np.sum(Pn)
-                        n=np.random.choice(self.n_list,p=Pn_scaled)
-                    else:
-                        n=0
-                    while not wigner_sampled:
-                        random_Q = np.random.uniform(-self.wigner_sample_max,self.wigner_sample_max)
-                        random_P = np.random.uniform(-self.wigner_sample_max,self.wigner_sample_max)
-                        
-                        W = calc_W(random_P,random_Q, n=n)
-    
-                        if W>np.random.uniform(0,1):
-                            for i in range(self.eq_geometry.natoms):
-                                new_geom[i,:]+=(random_Q/freq_factor)*nmode[i,:]*np.sqrt(1./(self.eq_geometry.atom_masses[i]*u_to_amu))*bohr_to_angstrom
-
-                            if T>0:
-                                self.samp_n_list.append(n)
-                            self.samp_q_list.append(random_Q)
-                            wigner_sampled = True
-
-                for n in range(self.eq_geometry.natoms):
-                    r_list.append(new_geom[n,:]*1e-10)
-                            
-                        
-            # NOTE: should probably rework to do everything on the y0 array then rotate this at the end (incl. velocities)
-            if self.random_rotate:
-                r_list_rot = random_rotation(r_list)
+        n_states = random_Q = None
+        if self.method=='gaussian':
+            positions = self.gaussian_positions(n_geoms, rng=rng)
+        elif self.method=='wigner':
+            positions, n_states, random_Q = self.wigner_positions(n_geoms, rng=rng)
+
+        charges = None
+        if self.charge_model is not None:
+            charges = self.charge_model.sample(positions, self.eq_geometry.element_list, rng=rng)
+
+        y0 = np.zeros((n_geoms, 6*natoms))
+        y0[:, :3*natoms] = positions.reshape(n_geoms, 3*natoms)
+        if self.random_rotate:
+            y0 = rotate_states(y0, rotation_matrices(n_geoms, method=self.rotation_method, rng=rng))
+        return(y0, samp_channel_idx.astype(self.channel_idx_dtype), n_states, random_Q, charges)
+
+    def pool_info(self):
+        """Settings of the pool, as stored in pool.json by save_pool."""
+        info = {'natoms': self.eq_geometry.natoms, 'n_geoms': self.n_geoms, 'method': self.method,
+                'random_rotate': self.random_rotate, 'rotation_method': self.rotation_method, 'T': self.T,
+                'nmax': self.nmax, 'wigner_sample_max': self.wigner_sample_max, 'sigma': None, 'channels': None,
+                'charge_model': None if self.charge_model is None else self.charge_model.settings}
+        if self.method=='gaussian':
+            info['sigma'] = np.asarray(self.sigma, dtype=float).tolist()
+        if self.multi_channel:
+            info['channels'] = [{'charges': channel.charges.tolist(), 'p': p, 'label': getattr(channel, 'label', None)}
+                                for channel, p in zip(self.channel_list, self.channel_p_list)]
+        return(info)
+
+    def save_pool(self, path):
+        """Write the pool to a directory: one .npy file per array (see pool_file_dict) and its settings in
+        pool.json. A pool generated with a pool_path is already written there, and only flushed.
+
+        :param path: directory of the pool"""
+        os.makedirs(path, exist_ok=True)
+        for name, fname in pool_file_dict.items():
+            arr = getattr(self, name, None)
+            if arr is None:
+                continue
+            if isinstance(arr, np.memmap) and os.path.abspath(arr.filename)==os.path.abspath(os.path.join(path, fname)):
+                arr.flush()
             else:
-                r_list_rot = r_list
-                        
-            for n in range(self.eq_geometry.natoms):
-                y0[3*n] = (r_list_rot[n][0])
-                y0[3*n+1] = (r_list_rot[n][1])
-                y0[3*n+2] = (r_list_rot[n][2])
-                
-            self.samp_y0_list.append(y0)
-            self.samp_charges_list.append(charges)
-            self.samp_masses_list.append(masses)
+                np.save(os.path.join(path, fname), arr)
+        with open(os.path.join(path, 'pool.json'), 'w') as f:
+            json.dump(self.pool_info(), f)
+
+    def load_pool_arrays(self, path, mode='r'):
+        """Memory-map the arrays of a pool written by save_pool.
+
+        :param path: directory of the pool
+        :param mode: mmap_mode of np.load (default 'r'), or None to read the arrays into memory"""
+        for name, fname in pool_file_dict.items():
+            if os.path.exists(os.path.join(path, fname)):
+                setattr(self, name, np.load(os.path.join(path, fname), mmap_mode=mode))
+
+    def open_pool(self, path, mode='r'):
+        """Reopen a pool written by save_pool (or generate_pool with a pool_path), without regenerating it.
+        The settings, the channel list and the charge model are restored from pool.json.
+
+        :param path: directory of the pool
+        :param mode: mmap_mode of np.load (default 'r'), or None to read the arrays into memory"""
+        with open(os.path.join(path, 'pool.json')) as f:
+            info = json.load(f)
+        if info['natoms']!=self.eq_geometry.natoms:
+            raise ValueError(f"Pool in {path} has {info['natoms']} atoms, but the geometry has {self.eq_geometry.natoms}")
+        self.n_geoms = info['n_geoms']
+        self.method = info['method']
+        self.random_rotate = info['random_rotate']
+        self.rotation_method = info.get('rotation_method', 'arvo')
+        self.T = info['T']
+        self.nmax = info['nmax']
+        self.wigner_sample_max = info['wigner_sample_max']
+        if info['sigma'] is not None:
+            self.sigma = np.array(info['sigma'])
+        if info['channels'] is not None:
+            self.set_channel_list([CEChannel(channel['charges'], channel['p'], channel['label'])
+                                   for channel in info['channels']])
+        if info.get('charge_model') is not None:
+            self.set_charge_model(ChargeStateModel(**info['charge_model']))
+        self.build_channel_cache()
+        self.eq_geometry.com_geometry()
+        if self.method=='wigner':
+            self.n_list = list(range(self.nmax))
+            self.wigner_table = get_wigner_table(self.eq_geometry.omegas, self.T, self.nmax, self.wigner_sample_max)
+            self.Pn_arr = self.wigner_table.Pn_arr
+            self.mode_matrix = self.wigner_mode_matrix()
+        self.pool_path = path if mode is not None else None
+        self.load_pool_arrays(path, mode=mode)
+
+    def gaussian_positions(self, n_geoms, rng=None):
+        """Sample geometries by Gaussian blurring of the (centre of mass) equilibrium geometry, all at once.
+
+        :param n_geoms: number of geometries
+        :param rng: np.random.Generator (default the global np.random state)
+
+        :return: (n_geoms,natoms,3) array of positions (in m)"""
+        natoms = self.eq_geometry.natoms
+        sigma = np.asarray(self.sigma, dtype=float)
+        if sigma.size==1:
+            sigma = np.full((natoms, 1), sigma.item())
+        elif sigma.shape==(3,) and natoms==3:
+            raise ValueError("For 3 atoms a (3,) sigma could be one per atom or one per axis, "
+                             "give a (3,3) array (one per atom and axis) instead")
+        elif sigma.shape==(natoms,):
+            sigma = sigma[:, None]
+        elif sigma.shape==(3,):
+            sigma = sigma[None, :]
+        elif sigma.shape!=(natoms, 3):
+            raise ValueError(f"sigma should be a number, or an array of shape ({natoms},), (3,) or ({natoms},3)")
+        rng = np.random if rng is None else rng
+        noise = rng.normal(size=(n_geoms, natoms, 3))*sigma
+        return((self.eq_geometry.atom_coords_com + noise)*1e-10)
+
+    def wigner_mode_matrix(self):
+        """Displacement of each atom per unit Q of each normal mode, from the mass-weighted normal modes.
+
+        :return: (n_modes,natoms,3) array (in angstrom)"""
+        freq_factor = np.sqrt(np.array(self.eq_geometry.omegas)*cm_to_hartree)
+        mass_factor = np.sqrt(1./(np.array(self.eq_geometry.atom_masses)*u_to_amu))
+        return(np.array(self.eq_geometry.nmodes_weighted)*mass_factor[None, :, None]*bohr_to_angstrom
+               / freq_factor[:, None, None])
+
+    def wigner_positions(self, n_geoms, rng=None):
+        """Sample geometries from the vibrational Wigner distribution, for all samples and modes at once.
+        At T>0 the vibrational state of each mode is drawn from its thermal populations (self.Pn_arr),
+        using the cached sampling tables of self.wigner_table (see ThermalWignerTable) and the mode displacements
+        of self.mode_matrix (see wigner_mode_matrix), both made by setup_pool.
+
+        :param n_geoms: number of geometries
+        :param rng: np.random.Generator (default the global np.random state)
+
+        :return: ((n_geoms,natoms,3) array of positions (in m), (n_geoms,n_modes) arrays of vibrational
+        states and Q)"""
+        n_states = self.wigner_table.sample_states(n_geoms, rng=rng)
+        random_Q = self.wigner_table.sample_Q(n_states, rng=rng)
+        positions = (self.eq_geometry.atom_coords_com + np.einsum('sm,mak->sak', random_Q, self.mode_matrix))*1e-10
+        return(positions, n_states, random_Q)
 
     def visualize_pool_2D(self, dim1=0,dim2=1, vmax=100, nbins=200):
         """Function for visualizing the 2D pool of geometries as a 2D histogram.
@@ -757,12 +1604,1949 @@ class StartingConditions:
         ax.set_xlabel('Q', fontsize=14)
         ax.set_ylabel('no.', fontsize=14)
         plt.show()
-            
+
+
+class CoulombEngine:
+    """Base class for the force engines used by CESim.run_sims. Holds the charges and masses of
+    one trajectory and provides the Newton equations; subclasses implement forces().
+
+    :param charges: array of charges (in C)
+    :param masses: array of masses (in kg)
+    :param coulomb_k: Coulomb constant, for integrating in units other than SI (default k)"""
+    def __init__(self, charges, masses, coulomb_k=k):
+        self.charges = np.array(charges, dtype=float)
+        self.masses = np.array(masses, dtype=float)
+        self.inv_masses = 1/self.masses
+        self.coulomb_k = coulomb_k
+        self.last_forces = None
+
+    def forces(self, positions):
+        """Calculate the Coulomb force on each charge.
+
+        :param positions: (natoms,3) array of positions (in m)
+
+        :return: (natoms,3) array of forces (in N)"""
+        raise NotImplementedError
+
+    def integrator_forces(self, positions, t=None):
+        """Forces for the integrator (see forces), kept with their time in self.last_forces, as (t, forces),
+        so the stop events (see make_stop_events) can reuse them without another force evaluation.
+
+        :param positions: (natoms,3) array of positions
+        :param t: time of the positions, if known (solve_ivp), otherwise None (symplectic integrators)"""
+        forces = self.forces(positions)
+        self.last_forces = (t, forces)
+        return(forces)
+
+    def newton_equations(self, t, y):
+        """Newton equations for ODE solver, with the same interface as CESim.newton_equations.
+
+        :param t: time (unused, the forces do not depend explicitly on time)
+        :param y: the first natoms*3 elements are x,y,z positions of each atom.
+        The next natoms*3 elements are vx,vy,vz of each atom
+
+        :return: dydt array"""
+        n_atoms = len(y)//6
+        dydt = np.empty_like(y)
+        dydt[:3*n_atoms] = y[3*n_atoms:]
+        acc = self.integrator_forces(y[:3*n_atoms].reshape(n_atoms, 3), t=t)*self.inv_masses[:, None]
+        dydt[3*n_atoms:] = acc.ravel()
+        return(dydt)
+
+    def force_error(self, positions, n_samples=100, forces=None):
+        """Compare forces from this engine against direct summation, for a subsample of atoms.
+        The subsample is evenly spaced through the atom list, so the global random state is untouched.
+
+        :param positions: (natoms,3) array of positions (in m)
+        :param n_samples: number of atoms used for the comparison (default 100)
+        :param forces: optional, forces already calculated by this engine for these positions
+
+        :return: dict with the rms and max of |F - F_direct|/rms(|F_direct|) over the subsample. The errors are
+        relative to the rms force of the subsample rather than to each atom's own force, which is zero for
+        neutral atoms (see ChargeStateModel)"""
+        if forces is None:
+            forces = self.forces(positions)
+        idx = np.unique(np.linspace(0, len(positions)-1, min(n_samples, len(positions))).astype(int))
+        f_engine = forces[idx]
+        f_direct = coulomb_forces_on(idx, positions, self.charges, coulomb_k=self.coulomb_k)
+        abs_err = np.linalg.norm(f_engine-f_direct, axis=1)
+        f_scale = np.sqrt(np.mean(np.sum(f_direct**2, axis=1)))
+        # an all-neutral subsample has no forces to compare against
+        rel_err = abs_err/f_scale if f_scale>0 else np.zeros_like(abs_err)
+        return({'rms_rel_error': np.sqrt(np.mean(rel_err**2)), 'max_rel_error': np.max(rel_err),
+                'n_samples': len(idx)})
+
+
+class VectorizedCoulombEngine(CoulombEngine):
+    """Force engine for a single trajectory using vectorized direct summation (see coulomb_forces).
+
+    :param charges: array of charges (in C)
+    :param masses: array of masses (in kg)
+    :param block_size: number of rows of the pair matrix handled at once (default 256)
+    :param coulomb_k: Coulomb constant, for integrating in units other than SI (default k)"""
+    def __init__(self, charges, masses, block_size=256, coulomb_k=k):
+        CoulombEngine.__init__(self, charges, masses, coulomb_k=coulomb_k)
+        self.block_size = block_size
+
+    def forces(self, positions):
+        """Calculate the Coulomb force on each charge.
+
+        :param positions: (natoms,3) array of positions (in m)
+
+        :return: (natoms,3) array of forces (in N)"""
+        return(coulomb_forces(positions, self.charges, block_size=self.block_size, coulomb_k=self.coulomb_k))
+
+
+class BarnesHutEngine(CoulombEngine):
+    """O(N log N) Barnes-Hut tree-code force engine, for large clusters.
+
+    Atoms are sorted along a Morton (z-order) curve, so every octree cell is a contiguous range
+    of the sorted atoms. Each cell is approximated by its total charge placed at its centre of charge,
+    and is used whenever size/distance < theta; otherwise it is opened (or summed directly if it is a leaf).
+    The tree walk is done level by level for a chunk of atoms at once, so it is vectorized in NumPy.
+
+    The full tree is rebuilt every rebuild_every force calls. In between, the tree is refit:
+    the atom ordering and cells are kept, and the cell charges, centres and sizes are recomputed
+    from the current positions.
+
+    :param charges: array of charges (in C)
+    :param masses: array of masses (in kg)
+    :param theta: opening angle. Smaller is more accurate and slower; theta=0 is direct summation (default 0.5)
+    :param leaf_size: max number of atoms in a leaf cell (default 16)
+    :param rebuild_every: rebuild the tree every this many force calls, refit otherwise (default 1)
+    :param max_depth: max depth of the octree (default 16)
+    :param particle_chunk: number of atoms walking the tree at once, limits memory (default 4096)
+    :param error_samples: if >0, on every rebuild compare against direct summation for this many atoms
+    and append the result (see force_error) to self.force_errors (default 0)
+    :param coulomb_k: Coulomb constant, for integrating in units other than SI (default k)"""
+    def __init__(self, charges, masses, theta=0.5, leaf_size=16, rebuild_every=1, max_depth=16,
+                 particle_chunk=4096, error_samples=0, coulomb_k=k):
+        CoulombEngine.__init__(self, charges, masses, coulomb_k=coulomb_k)
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.rebuild_every = rebuild_every
+        self.max_depth = max_depth
+        self.particle_chunk = particle_chunk
+        self.error_samples = error_samples
+        self.force_errors = []
+        self.n_calls = 0
+        self.n_builds = 0
+
+    def build_tree(self, positions):
+        """Sort atoms along a Morton curve and find the cells of each level of the octree."""
+        keys = morton_keys(positions, self.max_depth)
+        self.order = np.argsort(keys, kind='stable')
+        keys = keys[self.order]
+        n_atoms = len(positions)
+        self.level_starts = []
+        self.level_ends = []
+        self.level_leaf = []
+        for level in range(self.max_depth+1):
+            level_keys = keys >> np.uint64(3*(self.max_depth-level))
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(level_keys))+1))
+            ends = np.append(starts[1:], n_atoms)
+            is_leaf = (ends-starts <= self.leaf_size) | (level==self.max_depth)
+            self.level_starts.append(starts)
+            self.level_ends.append(ends)
+            self.level_leaf.append(is_leaf)
+            if is_leaf.all():
+                break
+        # children of each cell are a contiguous range of cells on the next level
+        self.level_children = []
+        for level in range(len(self.level_starts)-1):
+            next_starts = self.level_starts[level+1]
+            self.level_children.append((np.searchsorted(next_starts, self.level_starts[level]),
+                                        np.searchsorted(next_starts, self.level_ends[level])))
+        self.charges_sorted = self.charges[self.order]
+        self.n_builds += 1
+
+    def refit_tree(self, positions_sorted):
+        """Recompute the total charge, centre of charge and size of every cell for the current positions."""
+        weights = np.abs(self.charges_sorted)
+        self.level_q = []
+        self.level_centre = []
+        self.level_size = []
+        for starts in self.level_starts:
+            q_sum = np.add.reduceat(self.charges_sorted, starts)
+            w_sum = np.add.reduceat(weights, starts)
+            wr_sum = np.add.reduceat(weights[:, None]*positions_sorted, starts, axis=0)
+            r_sum = np.add.reduceat(positions_sorted, starts, axis=0)
+            counts = np.diff(np.append(starts, len(positions_sorted)))
+            # neutral cells have no force contribution, use their geometric centre
+            centre = np.where(w_sum[:, None]>0, wr_sum/np.where(w_sum>0, w_sum, 1)[:, None], r_sum/counts[:, None])
+            size = np.max(np.maximum.reduceat(positions_sorted, starts, axis=0)
+                          - np.minimum.reduceat(positions_sorted, starts, axis=0), axis=1)
+            self.level_q.append(q_sum)
+            self.level_centre.append(centre)
+            self.level_size.append(size)
+
+    def forces(self, positions):
+        """Calculate the Coulomb force on each charge with the Barnes-Hut approximation.
+
+        :param positions: (natoms,3) array of positions (in m)
+
+        :return: (natoms,3) array of forces (in N)"""
+        rebuilt = False
+        if self.n_calls%self.rebuild_every==0:
+            self.build_tree(positions)
+            rebuilt = True
+        self.n_calls += 1
+        positions_sorted = positions[self.order]
+        self.refit_tree(positions_sorted)
+
+        n_atoms = len(positions)
+        forces_sorted = np.zeros((n_atoms, 3))
+        for start in range(0, n_atoms, self.particle_chunk):
+            atoms = np.arange(start, min(start+self.particle_chunk, n_atoms))
+            forces_sorted += self.walk_tree(atoms, positions_sorted)
+        forces_sorted *= self.coulomb_k*self.charges_sorted[:, None]
+
+        forces = np.empty_like(forces_sorted)
+        forces[self.order] = forces_sorted
+        if rebuilt and self.error_samples>0:
+            self.force_errors.append(self.force_error(positions, self.error_samples, forces=forces))
+        return(forces)
+
+    def walk_tree(self, atoms, positions_sorted):
+        """Walk the tree for a set of (sorted) atom indices, level by level.
+
+        :return: (natoms,3) array of field (force/(k*q)) on the given atoms, zero elsewhere"""
+        n_atoms = len(positions_sorted)
+        field = np.zeros((n_atoms, 3))
+        frontier_atoms = atoms
+        frontier_cells = np.zeros(len(atoms), dtype=int)
+        for level in range(len(self.level_starts)):
+            if not len(frontier_atoms):
+                break
+            starts = self.level_starts[level][frontier_cells]
+            ends = self.level_ends[level][frontier_cells]
+            r = positions_sorted[frontier_atoms] - self.level_centre[level][frontier_cells]
+            d2 = np.einsum('ij,ij->i', r, r)
+            inside = (starts<=frontier_atoms) & (frontier_atoms<ends)
+            accept = ~inside & (self.level_size[level][frontier_cells]**2 < self.theta**2*d2)
+
+            # far cells: monopole approximation
+            q_over_r3 = self.level_q[level][frontier_cells[accept]]/(d2[accept]*np.sqrt(d2[accept]))
+            accumulate_rows(field, frontier_atoms[accept], r[accept]*q_over_r3[:, None])
+
+            # near leaf cells: direct summation with every atom in the cell
+            leaf = ~accept & self.level_leaf[level][frontier_cells]
+            pair_atoms, pair_others = expand_ranges(frontier_atoms[leaf], starts[leaf], ends[leaf])
+            not_self = pair_atoms!=pair_others
+            pair_atoms = pair_atoms[not_self]
+            pair_others = pair_others[not_self]
+            r = positions_sorted[pair_atoms] - positions_sorted[pair_others]
+            d2 = np.einsum('ij,ij->i', r, r)
+            accumulate_rows(field, pair_atoms, r*(self.charges_sorted[pair_others]/(d2*np.sqrt(d2)))[:, None])
+
+            # near internal cells: open them
+            opened = ~accept & ~self.level_leaf[level][frontier_cells]
+            if level<len(self.level_children):
+                child_lo, child_hi = self.level_children[level]
+                frontier_atoms, frontier_cells = expand_ranges(frontier_atoms[opened],
+                                                               child_lo[frontier_cells[opened]],
+                                                               child_hi[frontier_cells[opened]])
+        return(field)
+
+
+class FMMEngine(CoulombEngine):
+    """O(N) fast multipole method (FMM) force engine, for very large clusters.
+
+    This is a kernel-independent ('black-box') FMM on a uniform octree: the multipole and local
+    expansions of each cell are the equivalent charges and potentials on an order^3 grid of
+    Chebyshev nodes, so the translation operators are small fixed matrices that are precomputed once
+    and applied as batched matrix products. The tree depth is chosen so that leaves hold at most
+    leaf_size atoms on average, and the tree is rebuilt on every force call. The interaction lists (far
+    field M2L pairs and near field leaf pairs) only depend on which leaves are occupied, which rarely changes
+    between successive force calls, so they are kept and only rebuilt when it does (counted in self.n_list_builds).
+
+    The time spent in each phase (tree build, upward pass, interaction lists, downward pass,
+    near field) is accumulated in self.timings.
+
+    :param charges: array of charges (in C)
+    :param masses: array of masses (in kg)
+    :param order: expansion order, i.e. Chebyshev nodes per dimension. Higher is more accurate and slower (default 4)
+    :param leaf_size: max mean number of atoms per non-empty leaf (default 32)
+    :param depth: optional, fixed depth of the octree (overrides leaf_size)
+    :param chunk_size: number of atoms (or atom pairs, /64) handled at once, limits memory (default 16384)
+    :param error_samples: if >0, on every force call compare against direct summation for this many atoms
+    and append the result (see force_error) to self.force_errors (default 0)
+    :param coulomb_k: Coulomb constant, for integrating in units other than SI (default k)"""
+    def __init__(self, charges, masses, order=4, leaf_size=32, depth=None, chunk_size=16384, error_samples=0,
+                 coulomb_k=k):
+        CoulombEngine.__init__(self, charges, masses, coulomb_k=coulomb_k)
+        self.order = order
+        self.leaf_size = leaf_size
+        self.depth = depth
+        self.chunk_size = chunk_size
+        self.error_samples = error_samples
+        self.force_errors = []
+        self.timings = {'tree_build': 0., 'upward_pass': 0., 'interaction_lists': 0.,
+                        'downward_pass': 0., 'near_field': 0.}
+        self.n_calls = 0
+        self.n_list_builds = 0
+        self.list_leaf_ids = None
+
+        # fixed operators on the unit cell: Chebyshev node grid, child->parent (M2M) and parent->child (L2L)
+        nodes = chebyshev_nodes(order)
+        self.nodes_3d = np.stack(np.meshgrid(nodes, nodes, nodes, indexing='ij'), axis=-1).reshape(-1, 3)
+        m1 = [chebyshev_weights(order, (nodes+shift)/2).T for shift in (-1, 1)]
+        self.m2m = np.array([np.kron(np.kron(m1[ox], m1[oy]), m1[oz])
+                             for ox in (0, 1) for oy in (0, 1) for oz in (0, 1)])
+        # offsets (in cells) of the interaction list: children of the parent's neighbours that are
+        # not neighbours themselves. M2L matrices for each offset are made when first needed
+        offs = np.stack(np.meshgrid(*[np.arange(-3, 4)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+        self.m2l_offsets = offs[np.max(np.abs(offs), axis=1)>1]
+        self.m2l_cache = {}
+        self.near_offsets = offs[np.max(np.abs(offs), axis=1)<=1]
+
+    def m2l_matrix(self, offset_idx):
+        """M2L operator for a source cell at offset m2l_offsets[offset_idx] (unit cell size, 1/r kernel)."""
+        if offset_idx not in self.m2l_cache:
+            targets = self.nodes_3d*0.5
+            sources = self.m2l_offsets[offset_idx] + self.nodes_3d*0.5
+            r = targets[:, None, :] - sources[None, :, :]
+            self.m2l_cache[offset_idx] = 1/np.sqrt(np.einsum('ijk,ijk->ij', r, r))
+        return(self.m2l_cache[offset_idx])
+
+    def build_tree(self, positions):
+        """Sort atoms into the leaves of a uniform octree and find the non-empty cells on every level."""
+        n_atoms = len(positions)
+        self.r_min = positions.min(axis=0)
+        extent = np.max(positions.max(axis=0)-self.r_min)
+        self.box_size = extent*(1+1e-9) if extent>0 else 1.0
+        if self.depth is None:
+            # deepen the tree until the non-empty leaves hold leaf_size atoms on average
+            depth = 0
+            while depth<10 and n_atoms/len(np.unique(self.leaf_ids(positions, depth)))>self.leaf_size:
+                depth += 1
+        else:
+            depth = self.depth
+        self.tree_depth = depth
+        n_side = 2**depth
+        leaf_ids = self.leaf_ids(positions, depth)
+        self.order_atoms = np.argsort(leaf_ids, kind='stable')
+        leaf_ids, self.leaf_start = np.unique(leaf_ids[self.order_atoms], return_index=True)
+        self.leaf_end = np.append(self.leaf_start[1:], n_atoms)
+        self.atom_leaf = np.repeat(np.arange(len(leaf_ids)), self.leaf_end-self.leaf_start)
+
+        # non-empty cells on each level, with their integer coordinates and parent cell
+        self.level_ijk = [None]*(depth+1)
+        self.level_ids = [None]*(depth+1)
+        self.level_parent = [None]*(depth+1)
+        self.level_ijk[depth] = np.stack([leaf_ids//n_side**2, (leaf_ids//n_side)%n_side, leaf_ids%n_side], axis=1)
+        self.level_ids[depth] = leaf_ids
+        for level in range(depth-1, -1, -1):
+            child_ijk = self.level_ijk[level+1]
+            parent_ijk = child_ijk >> 1
+            n_side = 2**level
+            parent_ids = (parent_ijk[:, 0]*n_side + parent_ijk[:, 1])*n_side + parent_ijk[:, 2]
+            ids, first, inverse = np.unique(parent_ids, return_index=True, return_inverse=True)
+            self.level_ids[level] = ids
+            self.level_ijk[level] = parent_ijk[first]
+            self.level_parent[level+1] = inverse
+
+    def leaf_ids(self, positions, depth):
+        """Linear index of the cell containing each atom, for a uniform octree of a given depth."""
+        n_side = 2**depth
+        ijk = np.clip(((positions-self.r_min)/(self.box_size/n_side)).astype(np.int64), 0, n_side-1)
+        return((ijk[:, 0]*n_side + ijk[:, 1])*n_side + ijk[:, 2])
+
+    def find_cells(self, level, ijk):
+        """Look up cells by integer coordinates on a level.
+
+        :return: (index of the cell, boolean array of whether it exists)"""
+        n_side = 2**level
+        inside = np.all((ijk>=0) & (ijk<n_side), axis=1)
+        ids = (ijk[:, 0]*n_side + ijk[:, 1])*n_side + ijk[:, 2]
+        idx = np.minimum(np.searchsorted(self.level_ids[level], ids), len(self.level_ids[level])-1)
+        found = inside & (self.level_ids[level][idx]==ids)
+        return(idx, found)
+
+    def build_interaction_lists(self):
+        """Find, for the current tree, the M2L source cells of each cell (as (offset index, target cells,
+        source cells) for each offset on each level, in self.m2l_lists) and the neighbouring leaves of each leaf
+        (as arrays of target and source leaves, in self.near_pairs). The occupied leaves they were made for are
+        kept in self.list_leaf_ids."""
+        depth = self.tree_depth
+        self.m2l_lists = [None]*(depth+1)
+        for level in range(2, depth+1):
+            target_ijk = self.level_ijk[level]
+            source_ijk = target_ijk[:, None, :] + self.m2l_offsets[None, :, :]
+            parent_adjacent = np.max(np.abs((source_ijk >> 1) - (target_ijk[:, None, :] >> 1)), axis=2)<=1
+            source_idx, found = self.find_cells(level, source_ijk.reshape(-1, 3))
+            valid = found.reshape(parent_adjacent.shape) & parent_adjacent
+            source_idx = source_idx.reshape(parent_adjacent.shape)
+            self.m2l_lists[level] = []
+            for offset_idx in np.flatnonzero(valid.any(axis=0)):
+                targets = np.flatnonzero(valid[:, offset_idx])
+                self.m2l_lists[level].append((offset_idx, targets, source_idx[targets, offset_idx]))
+        leaf_ijk = self.level_ijk[depth]
+        neighbour_idx, found = self.find_cells(depth, (leaf_ijk[:, None, :] + self.near_offsets[None, :, :]).reshape(-1, 3))
+        self.near_pairs = (np.repeat(np.arange(len(leaf_ijk)), len(self.near_offsets))[found], neighbour_idx[found])
+        self.list_leaf_ids = (depth, self.level_ids[depth])
+        self.n_list_builds += 1
+
+    def leaf_chunks(self):
+        """Split the sorted atoms into chunks of whole leaves, of about chunk_size atoms each."""
+        bounds = self.leaf_start[np.searchsorted(self.leaf_start,
+                                                 np.arange(0, self.leaf_end[-1], self.chunk_size))]
+        bounds = np.unique(np.append(bounds, self.leaf_end[-1]))
+        return(list(zip(bounds[:-1], bounds[1:])))
+
+    def leaf_coordinates(self, positions_sorted, start, stop):
+        """Coordinates of sorted atoms start:stop relative to their leaf, scaled to [-1,1]."""
+        h_leaf = self.box_size/2**self.tree_depth
+        centres = self.r_min + (self.level_ijk[self.tree_depth][self.atom_leaf[start:stop]]+0.5)*h_leaf
+        return((positions_sorted[start:stop]-centres)/(h_leaf/2))
+
+    def forces(self, positions):
+        """Calculate the Coulomb force on each charge with the FMM.
+
+        :param positions: (natoms,3) array of positions (in m)
+
+        :return: (natoms,3) array of forces (in N)"""
+        p = self.order
+        t0 = time.perf_counter()
+        self.build_tree(positions)
+        depth = self.tree_depth
+        positions_sorted = positions[self.order_atoms]
+        charges_sorted = self.charges[self.order_atoms]
+        n_atoms = len(positions)
+        t1 = time.perf_counter()
+        self.timings['tree_build'] += t1-t0
+
+        # upward pass: P2M on the leaves, then M2M up to level 2
+        multipoles = [None]*(depth+1)
+        if depth>=2:
+            multipoles[depth] = np.zeros((len(self.leaf_start), p**3))
+            for start, stop in self.leaf_chunks():
+                u = self.leaf_coordinates(positions_sorted, start, stop)
+                s3 = np.einsum('ia,ib,ic->iabc', chebyshev_weights(p, u[:, 0]), chebyshev_weights(p, u[:, 1]),
+                               chebyshev_weights(p, u[:, 2])).reshape(-1, p**3)
+                leaf_lo = self.atom_leaf[start]
+                leaf_hi = self.atom_leaf[stop-1]+1
+                multipoles[depth][leaf_lo:leaf_hi] = np.add.reduceat(s3*charges_sorted[start:stop, None],
+                                                                    self.leaf_start[leaf_lo:leaf_hi]-start, axis=0)
+            for level in range(depth-1, 1, -1):
+                multipoles[level] = np.zeros((len(self.level_ids[level]), p**3))
+                octant = self.octants(level+1)
+                for o in range(8):
+                    sel = octant==o
+                    np.add.at(multipoles[level], self.level_parent[level+1][sel],
+                              multipoles[level+1][sel] @ self.m2m[o].T)
+        t2 = time.perf_counter()
+        self.timings['upward_pass'] += t2-t1
+
+        # interaction lists: M2L from well separated cells whose parents are neighbours. The lists are
+        # reused while the same leaves are occupied
+        if self.list_leaf_ids is None or self.list_leaf_ids[0]!=depth \
+                or not np.array_equal(self.list_leaf_ids[1], self.level_ids[depth]):
+            self.build_interaction_lists()
+        locals_ = [None]*(depth+1)
+        for level in range(2, depth+1):
+            h = self.box_size/2**level
+            locals_[level] = np.zeros((len(self.level_ijk[level]), p**3))
+            for offset_idx, targets, sources in self.m2l_lists[level]:
+                locals_[level][targets] += multipoles[level][sources] @ self.m2l_matrix(offset_idx).T/h
+        t3 = time.perf_counter()
+        self.timings['interaction_lists'] += t3-t2
+
+        # downward pass: L2L down to the leaves, then L2P (field from the gradient of the local expansion)
+        field_sorted = np.zeros((n_atoms, 3))
+        if depth>=2:
+            for level in range(2, depth):
+                octant = self.octants(level+1)
+                for o in range(8):
+                    sel = np.flatnonzero(octant==o)
+                    locals_[level+1][sel] += locals_[level][self.level_parent[level+1][sel]] @ self.m2m[o]
+            h_leaf = self.box_size/2**depth
+            for start, stop in self.leaf_chunks():
+                u = self.leaf_coordinates(positions_sorted, start, stop)
+                s = [chebyshev_weights(p, u[:, dim]) for dim in range(3)]
+                ds = [chebyshev_weights(p, u[:, dim], derivative=True) for dim in range(3)]
+                local = locals_[depth][self.atom_leaf[start:stop]].reshape(-1, p, p, p)
+                field_sorted[start:stop, 0] = -np.einsum('iabc,ia,ib,ic->i', local, ds[0], s[1], s[2])
+                field_sorted[start:stop, 1] = -np.einsum('iabc,ia,ib,ic->i', local, s[0], ds[1], s[2])
+                field_sorted[start:stop, 2] = -np.einsum('iabc,ia,ib,ic->i', local, s[0], s[1], ds[2])
+            field_sorted *= 2/h_leaf
+        t4 = time.perf_counter()
+        self.timings['downward_pass'] += t4-t3
+
+        # near field: direct summation with the atoms in the same and neighbouring leaves
+        target_leaf, source_leaf = self.near_pairs
+        pair_counts = (self.leaf_end-self.leaf_start)[target_leaf]*(self.leaf_end-self.leaf_start)[source_leaf]
+        pair_bounds = np.searchsorted(np.cumsum(pair_counts), np.arange(0, np.sum(pair_counts), 64*self.chunk_size))
+        pair_bounds = np.unique(np.append(pair_bounds, len(target_leaf)))
+        for lo, hi in zip(pair_bounds[:-1], pair_bounds[1:]):
+            leaf_pair, atoms = expand_ranges(np.arange(lo, hi), self.leaf_start[target_leaf[lo:hi]],
+                                             self.leaf_end[target_leaf[lo:hi]])
+            atoms, others = expand_ranges(atoms, self.leaf_start[source_leaf[leaf_pair]],
+                                          self.leaf_end[source_leaf[leaf_pair]])
+            not_self = atoms!=others
+            atoms = atoms[not_self]
+            others = others[not_self]
+            r = positions_sorted[atoms] - positions_sorted[others]
+            d2 = np.einsum('ij,ij->i', r, r)
+            accumulate_rows(field_sorted, atoms, r*(charges_sorted[others]/(d2*np.sqrt(d2)))[:, None])
+        self.timings['near_field'] += time.perf_counter()-t4
+        self.n_calls += 1
+
+        forces = np.empty_like(field_sorted)
+        forces[self.order_atoms] = self.coulomb_k*charges_sorted[:, None]*field_sorted
+        if self.error_samples>0:
+            self.force_errors.append(self.force_error(positions, self.error_samples, forces=forces))
+        return(forces)
+
+    def octants(self, level):
+        """Octant (0-7) of each cell on a level within its parent cell."""
+        ijk = self.level_ijk[level] & 1
+        return(4*ijk[:, 0] + 2*ijk[:, 1] + ijk[:, 2])
+
+
+class BatchedCoulombEngine:
+    """Force engine for a batch of trajectories of the same molecule, integrated together with
+    rk45_batched. Forces are calculated by direct summation for all trajectories at once, so this
+    is intended for small molecules (memory scales as n_samples*natoms^2).
+
+    :param charges: (n_samples,natoms) array of charges (in C), or (n_channels,natoms) if channel_idx is given
+    :param masses: (n_samples,natoms) array of masses (in kg), or (n_channels,natoms) if channel_idx is given
+    :param coulomb_k: Coulomb constant, for integrating in units other than SI (default k)
+    :param channel_idx: optional (n_samples) array of the row of charges and masses used by each sample,
+    so the pair matrices are only stored once per channel"""
+    def __init__(self, charges, masses, coulomb_k=k, channel_idx=None):
+        self.charges = np.array(charges, dtype=float)
+        self.inv_masses = 1/np.array(masses, dtype=float)
+        self.kqq = coulomb_k*self.charges[:, :, None]*self.charges[:, None, :]
+        self.rows = np.arange(len(self.charges)) if channel_idx is None else np.asarray(channel_idx)
+
+    def newton_equations(self, t, y, idx):
+        """Newton equations for a batch of trajectories.
+
+        :param t: array of times (unused)
+        :param y: (len(idx),natoms*6) array of states, each in the same layout as CESim.newton_equations
+        :param idx: indices of the trajectories in the batch
+
+        :return: (len(idx),natoms*6) array of dydt"""
+        n_atoms = y.shape[1]//6
+        positions = y[:, :3*n_atoms].reshape(-1, n_atoms, 3)
+        r_ij = positions[:, :, None, :] - positions[:, None, :, :]
+        r2 = np.einsum('bijk,bijk->bij', r_ij, r_ij)
+        inv_r3 = np.divide(1.0, r2*np.sqrt(r2), out=np.zeros_like(r2), where=r2>0)
+        rows = self.rows[idx]
+        acc = np.einsum('bijk,bij->bik', r_ij, self.kqq[rows]*inv_r3)*self.inv_masses[rows][:, :, None]
+        dydt = np.empty_like(y)
+        dydt[:, :3*n_atoms] = y[:, 3*n_atoms:]
+        dydt[:, 3*n_atoms:] = acc.reshape(len(y), -1)
+        return(dydt)
+
+
+# force engines selectable with CESim.run_sims(force_method=...). 'loop' uses CESim.newton_equations
+force_engine_dict = {'vectorized': VectorizedCoulombEngine,
+                     'barnes_hut': BarnesHutEngine,
+                     'fmm': FMMEngine}
+
+# internal unit systems selectable with CESim.run_sims(units=...), as (length, time, mass, charge) in SI.
+# 'natural' is angstrom, femtosecond, atomic mass unit and elementary charge, in which positions,
+# velocities and times of a Coulomb explosion are all of order one
+unit_system_dict = {'SI': (1., 1., 1., 1.),
+                    'natural': (1e-10, 1e-15, u, e)}
+
+
+def unit_scales(units):
+    """Scales of an internal unit system (see unit_system_dict), in SI.
+
+    :param units: name of the unit system
+
+    :return: dict of the length, time, mass, charge, velocity and energy scales, and the Coulomb constant
+    in the unit system (coulomb_k)"""
+    if units not in unit_system_dict:
+        raise ValueError(f"Unknown unit system {units}. Options are: {list(unit_system_dict)}")
+    length, time_scale, mass, charge = unit_system_dict[units]
+    velocity = length/time_scale
+    energy = mass*velocity**2
+    return({'length': length, 'time': time_scale, 'mass': mass, 'charge': charge, 'velocity': velocity,
+            'energy': energy, 'coulomb_k': k*charge**2/(energy*length)})
+
+
+def scale_state(y, scales, to_internal=True):
+    """Convert states between SI and internal units.
+
+    :param y: state, or array of states along the first axis, in the same layout as y in CESim.newton_equations
+    :param scales: dict from unit_scales
+    :param to_internal: if True convert from SI to internal units, otherwise from internal units to SI
+
+    :return: converted copy of y"""
+    y = np.array(y, dtype=float)
+    n_atoms = y.shape[0]//6
+    factors = np.concatenate([np.full(3*n_atoms, scales['length']), np.full(3*n_atoms, scales['velocity'])])
+    factors = factors.reshape((-1,) + (1,)*(y.ndim-1))
+    return(y/factors if to_internal else y*factors)
+
+
+def make_engine(charges, masses, settings):
+    """Create the force engine (see force_engine_dict) for one trajectory, in the internal units of
+    settings['units'] (see unit_scales).
+
+    :param charges: array of charges (in C)
+    :param masses: array of masses (in kg)
+    :param settings: dict of simulation settings (see CESim.run_sims)
+
+    :return: force engine object"""
+    scales = unit_scales(settings['units'])
+    force_kwargs = dict(settings['force_kwargs'])
+    return(force_engine_dict[settings['force_method']](np.asarray(charges)/scales['charge'],
+                                                       np.asarray(masses)/scales['mass'],
+                                                       coulomb_k=scales['coulomb_k'], **force_kwargs))
+
+
+# integrators implemented in integrate_symplectic, any other integrator is passed to solve_ivp as the method
+symplectic_integrator_list = ['verlet', 'yoshida4']
+
+# Yoshida 4th order coefficients. integrate_symplectic uses the kick-drift form (kicks c, drifts d), which
+# ends on a kick with the forces at the final positions, so they are reused by the next step (as in velocity Verlet)
+yoshida_w1 = 1/(2-2**(1/3))
+yoshida_w0 = -2**(1/3)/(2-2**(1/3))
+yoshida_c = [yoshida_w1/2, (yoshida_w0+yoshida_w1)/2, (yoshida_w0+yoshida_w1)/2, yoshida_w1/2]
+yoshida_d = [yoshida_w1, yoshida_w0, yoshida_w1, 0]
+
+
+def coulomb_potential_energy(positions, charges, block_size=256, coulomb_k=k):
+    """Calculate the total Coulomb potential energy of a set of charges (each pair once).
+
+    :param positions: (natoms,3) array of positions (in m)
+    :param charges: array of charges (in C)
+    :param block_size: number of rows of the pair matrix handled at once (default 256)
+    :param coulomb_k: Coulomb constant, for units other than SI (default k)
+
+    :return: potential energy (in J)"""
+    n_atoms = len(positions)
+    energy = 0.
+    for start in range(0, n_atoms, block_size):
+        stop = min(start+block_size, n_atoms)
+        r_ij = positions[start:stop, None, :] - positions[None, start:, :]
+        r = np.sqrt(np.einsum('ijk,ijk->ij', r_ij, r_ij))
+        upper = np.arange(start, n_atoms)[None, :] > np.arange(start, stop)[:, None]
+        inv_r = np.divide(1.0, r, out=np.zeros_like(r), where=upper)
+        energy += coulomb_k*np.sum(charges[start:stop, None]*charges[None, start:]*inv_r)
+    return(energy)
+
+
+def asymptotic_extrapolation(y, charges, masses, block_size=256, coulomb_k=k):
+    """Add the remaining Coulomb potential energy of a state to the velocities, to extrapolate them to t=infinity.
+
+    Each pair is treated as an isolated two-body problem: its potential energy k*q_i*q_j/r_ij is added to
+    the kinetic energy of the relative motion along r_ij, through equal and opposite impulses (so momentum
+    is conserved). The pair impulses are then scaled together so the kinetic energy increases by exactly
+    the total remaining potential energy.
+
+    :param y: state, in the same layout as y in CESim.newton_equations (in SI)
+    :param charges: array of charges (in C)
+    :param masses: array of masses (in kg)
+    :param block_size: number of rows of the pair matrix handled at once (default 256)
+    :param coulomb_k: Coulomb constant, for units other than SI (default k)
+
+    :return: (extrapolated state, with the same positions and corrected velocities; remaining potential energy (in J))"""
+    n_atoms = len(y)//6
+    positions = np.reshape(y[:3*n_atoms], (n_atoms, 3))
+    velocities = np.reshape(y[3*n_atoms:], (n_atoms, 3))
+    pe_residual = coulomb_potential_energy(positions, charges, block_size=block_size, coulomb_k=coulomb_k)
+    impulses = np.zeros((n_atoms, 3))
+    for start in range(0, n_atoms, block_size):
+        stop = min(start+block_size, n_atoms)
+        r_ij = positions[start:stop, None, :] - positions[None, start:, :]
+        r = np.sqrt(np.einsum('ijk,ijk->ij', r_ij, r_ij))
+        upper = np.arange(start, n_atoms)[None, :] > np.arange(start, stop)[:, None]
+        inv_r = np.divide(1.0, r, out=np.zeros_like(r), where=upper)
+        r_hat = r_ij*inv_r[:, :, None]
+        mu = masses[start:stop, None]*masses[None, start:]/(masses[start:stop, None]+masses[None, start:])
+        u = np.einsum('ijk,ijk->ij', velocities[start:stop, None, :]-velocities[None, start:, :], r_hat)
+        pair_energy = coulomb_k*charges[start:stop, None]*charges[None, start:]*inv_r
+        u_final = np.sqrt(np.maximum(u**2 + 2*pair_energy/mu, 0))
+        j_ij = r_hat*(mu*(u_final-u)*upper)[:, :, None]
+        impulses[start:stop] += j_ij.sum(axis=1)
+        impulses[start:] -= j_ij.sum(axis=0)
+    dv = impulses/masses[:, None]
+    # scale s of the impulses so that sum(m*(v+s*dv)**2)/2 = KE + pe_residual
+    a = 0.5*np.sum(masses[:, None]*dv**2)
+    b = np.sum(masses[:, None]*velocities*dv)
+    scale = (-b + np.sqrt(max(b**2 + 4*a*pe_residual, 0)))/(2*a) if a>0 else 0.
+    y_final = np.array(y, dtype=float)
+    y_final[3*n_atoms:] = (velocities + scale*dv).ravel()
+    return(y_final, pe_residual)
+
+
+def nearest_neighbour_distance(positions):
+    """Calculate the smallest distance between any two atoms.
+
+    :param positions: (natoms,3) array of positions
+
+    :return: minimum interatomic distance"""
+    if len(positions)<2:
+        return(np.inf)
+    if len(positions)<=256:
+        r_ij = positions[:, None, :] - positions[None, :, :]
+        r2 = np.einsum('ijk,ijk->ij', r_ij, r_ij)
+        np.fill_diagonal(r2, np.inf)
+        return(np.sqrt(np.min(r2)))
+    distances, _ = scipy.spatial.cKDTree(positions).query(positions, k=2)
+    return(np.min(distances[:, 1]))
+
+
+def integrate_symplectic(engine, y0, t_eval, method='verlet', eta=0.02, max_steps=10000000, events=None):
+    """Integrate the Newton equations with a symplectic (velocity Verlet or 4th order Yoshida) integrator.
+
+    The step size is dt = eta*sqrt(r_min/a_max), from the current minimum interatomic distance r_min and
+    maximum acceleration a_max, and is only shortened to land exactly on the last time in t_eval. As all
+    the ions repel each other, the step size grows quickly once the Coulomb energy has become kinetic.
+    As the step size changes the scheme is not strictly symplectic, so the relative energy drift
+    (E_final - E_initial)/|E_initial| is reported.
+
+    Events work as the terminal events of solve_ivp with direction=-1: after each step every event function
+    is evaluated, and the integration stops at the end of the first step where one of them becomes negative.
+
+    :param engine: force engine (see CoulombEngine)
+    :param y0: initial state, in the same layout as y in CESim.newton_equations
+    :param t_eval: times at which to store the solution
+    :param method: ['verlet', 'yoshida4'] (default 'verlet')
+    :param eta: step size parameter, smaller is more accurate (default 0.02)
+    :param max_steps: max number of steps
+    :param events: optional list of event functions event(t,y), which stop the integration when they become negative
+
+    :return: result with t, y ((natoms*6,len(t)) array), nfev, n_steps, energy_drift, status, t_events
+    and y_events, as from solve_ivp"""
+    n_atoms = len(y0)//6
+    x = np.array(y0[:3*n_atoms], dtype=float).reshape(n_atoms, 3)
+    v = np.array(y0[3*n_atoms:], dtype=float).reshape(n_atoms, 3)
+    masses = engine.masses[:, None]
+
+    def energy(x, v):
+        return(0.5*np.sum(masses*v**2) + coulomb_potential_energy(x, engine.charges, coulomb_k=engine.coulomb_k))
+
+    energy_0 = energy(x, v)
+    a = engine.integrator_forces(x)*engine.inv_masses[:, None]
+    nfev = 1
+    t = 0.
+    y_out = np.zeros((len(y0), len(t_eval)))
+    i_eval = 0
+    n_steps = 0
+    t_end = t_eval[-1]
+    events = events if events else []
+    t_events = [[] for event in events]
+    y_events = [[] for event in events]
+    while n_steps<max_steps and t<t_end:
+        a_max = np.sqrt(np.max(np.sum(a**2, axis=1)))
+        with np.errstate(divide='ignore'):
+            dt = eta*np.sqrt(nearest_neighbour_distance(x)/a_max)
+        if dt>=t_end-t:
+            dt = t_end-t
+            t_next = t_end
+        else:
+            t_next = t+dt
+        # times in t_eval passed during this step are stored from a 2nd order expansion about the current
+        # state, so the output times do not limit the step size. The final time is landed on exactly
+        while i_eval<len(t_eval) and t_eval[i_eval]<t_next:
+            tau = t_eval[i_eval]-t
+            y_out[:3*n_atoms, i_eval] = (x + v*tau + 0.5*a*tau**2).ravel()
+            y_out[3*n_atoms:, i_eval] = (v + a*tau).ravel()
+            i_eval += 1
+
+        if method=='verlet':
+            v += 0.5*dt*a
+            x += dt*v
+            a = engine.integrator_forces(x)*engine.inv_masses[:, None]
+            v += 0.5*dt*a
+            nfev += 1
+        elif method=='yoshida4':
+            for c, d in zip(yoshida_c, yoshida_d):
+                v += c*dt*a
+                if d:
+                    x += d*dt*v
+                    a = engine.integrator_forces(x)*engine.inv_masses[:, None]
+                    nfev += 1
+        else:
+            raise ValueError(f"Unknown symplectic integrator {method}. Options are: {symplectic_integrator_list}")
+        t = t_next
+        n_steps += 1
+        if events and t<t_end:
+            y = np.concatenate((x.ravel(), v.ravel()))
+            triggered = [event(t, y)<0 for event in events]
+            if any(triggered):
+                t_events[triggered.index(True)].append(t)
+                y_events[triggered.index(True)].append(y)
+                break
+    status = 1 if any(len(t_event) for t_event in t_events) else 0
+    if t<t_end and not status:
+        print(f'WARNING: symplectic integration stopped at t={t} after {max_steps} steps')
+        status = -1
+    if status==0:
+        y_out[:3*n_atoms, i_eval:] = x.ravel()[:, None]
+        y_out[3*n_atoms:, i_eval:] = v.ravel()[:, None]
+        i_eval = len(t_eval)
+
+    energy_drift = (energy(x, v)-energy_0)/abs(energy_0)
+    return(scipy.optimize.OptimizeResult(t=np.array(t_eval[:i_eval]), y=y_out[:, :i_eval], nfev=nfev,
+                                         n_steps=n_steps, energy_drift=energy_drift, status=status,
+                                         success=status>=0, t_events=[np.array(t_e) for t_e in t_events],
+                                         y_events=[np.array(y_e) for y_e in y_events]))
+
+
+def integrate_final_state(fun, y0, t_end, method='RK45', rtol=1e-3, atol=1e-6, events=None, **kwargs):
+    """Integrate from t=0 to t_end and keep only the final state. The scipy solver object is stepped
+    directly, so unlike solve_ivp no intermediate states are stored or interpolated.
+
+    Events work as in solve_ivp (with the terminal and direction attributes): after each step the event
+    functions are evaluated, and the roots of those that crossed zero are found on the dense output of the step.
+
+    :param fun: right hand side function fun(t,y)
+    :param y0: initial state
+    :param t_end: final time
+    :param method: name of a scipy.integrate solver (e.g. 'RK45', 'DOP853', 'LSODA') or a solver class (default 'RK45')
+    :param rtol: relative tolerance (default 1e-3)
+    :param atol: absolute tolerance (default 1e-6)
+    :param events: optional list of event functions event(t,y)
+    :param kwargs: passed to the solver
+
+    :return: result with t (the final time), y ((len(y0),1) array of the final state), nfev, n_steps, status,
+    message, t_events and y_events, as from solve_ivp"""
+    solver_class = getattr(scipy.integrate, method) if isinstance(method, str) else method
+    solver = solver_class(fun, 0., y0, t_end, rtol=rtol, atol=atol, **kwargs)
+    events = events if events else []
+    t_events = [[] for event in events]
+    y_events = [[] for event in events]
+    event_values = np.array([event(0., y0) for event in events])
+    directions = np.array([getattr(event, 'direction', 0) for event in events])
+    n_steps = 0
+    status = None
+    # the state returned if the first step already fails
+    t, y = solver.t, solver.y
+    while status is None:
+        message = solver.step()
+        n_steps += 1
+        if solver.status=='finished':
+            status = 0
+        elif solver.status=='failed':
+            status = -1
+            break
+        t, y = solver.t, solver.y
+        if events:
+            new_values = np.array([event(t, y) for event in events])
+            up = (event_values<=0) & (new_values>=0)
+            down = (event_values>=0) & (new_values<=0)
+            active = np.nonzero((up & (directions>0)) | (down & (directions<0)) | ((up | down) & (directions==0)))[0]
+            if len(active):
+                sol = solver.dense_output()
+                roots = np.array([scipy.optimize.brentq(lambda t_root: events[i](t_root, sol(t_root)), solver.t_old, t,
+                                                        xtol=4*np.finfo(float).eps, rtol=4*np.finfo(float).eps)
+                                  for i in active])
+                order = np.argsort(roots)
+                active, roots = active[order], roots[order]
+                terminal = [getattr(events[i], 'terminal', False) for i in active]
+                if any(terminal):
+                    n_roots = terminal.index(True) + 1
+                    active, roots = active[:n_roots], roots[:n_roots]
+                    t, y = roots[-1], sol(roots[-1])
+                    status = 1
+                for i, t_root in zip(active, roots):
+                    t_events[i].append(t_root)
+                    y_events[i].append(sol(t_root))
+            event_values = new_values
+    if status==0:
+        message = 'The solver successfully reached the end of the integration interval.'
+    elif status==1:
+        message = 'A termination event occurred.'
+    return(scipy.optimize.OptimizeResult(t=np.array([t]), y=np.array(y)[:, None], nfev=solver.nfev,
+                                         njev=solver.njev, nlu=solver.nlu, n_steps=n_steps, status=status,
+                                         message=message, success=status>=0,
+                                         t_events=[np.array(t_e) for t_e in t_events],
+                                         y_events=[np.array(y_e) for y_e in y_events]))
+
+
+def integrate_trajectory(rhs, engine, y0, settings):
+    """Integrate one trajectory, with solve_ivp or one of the symplectic integrators, stopping early
+    if any of the stop events (see make_stop_events) are triggered.
+
+    :param rhs: right hand side function rhs(t,y) for solve_ivp
+    :param engine: force engine (see CoulombEngine), used by the symplectic integrators and stop events
+    :param y0: initial state, in the same layout as y in CESim.newton_equations
+    :param settings: dict of simulation settings (see CESim.run_sims). If settings['final_state_only'] is set,
+    the trajectory is integrated to settings['tmax'] without storing intermediate states (see integrate_final_state)
+
+    :return: result from solve_ivp, integrate_final_state or integrate_symplectic, with the final state added as y_final. If the
+    integration was stopped early, the stop time is added as t_stop, and if asymptotic_fraction is set the
+    potential energy added analytically (see asymptotic_extrapolation) is added as pe_residual.
+    If settings['units'] is not 'SI', the engine works in those units (see make_engine) and the
+    integration is done in them, but the result is converted back to SI"""
+    units = settings.get('units', 'SI')
+    if units!='SI':
+        scales = unit_scales(units)
+        y0 = scale_state(y0, scales)
+        settings = dict(settings, tmax=settings['tmax']/scales['time'],
+                        timebins=None if settings['timebins'] is None else np.asarray(settings['timebins'])/scales['time'],
+                        ke_window=settings['ke_window']/scales['time'])
+    events = make_stop_events(engine, y0, settings)
+    if settings['integrator'] in symplectic_integrator_list:
+        t_eval = [settings['tmax']] if settings['final_state_only'] else settings['timebins']
+        solution = integrate_symplectic(engine, y0, t_eval, method=settings['integrator'],
+                                        events=events, **settings['integrator_kwargs'])
+    elif settings['final_state_only']:
+        solution = integrate_final_state(rhs, y0, settings['tmax'], method=settings['integrator'],
+                                         rtol=settings['rtol'], atol=settings['atol'], events=events,
+                                         **settings['integrator_kwargs'])
+    else:
+        solution = solve_ivp(rhs, [0, settings['tmax']], y0, method=settings['integrator'],
+                             t_eval=settings['timebins'], rtol=settings['rtol'], atol=settings['atol'],
+                             events=events if events else None, **settings['integrator_kwargs'])
+    # a trajectory stopped before the first output time (e.g. final_state_only) has no output, only its event state
+    y_final = solution.y[:, -1] if np.shape(solution.y)[1] else None
+    if solution.status==1:
+        for t_event, y_event in zip(solution.t_events, solution.y_events):
+            if len(t_event):
+                solution.t_stop = t_event[0]
+                y_final = y_event[0]
+                break
+    if settings['asymptotic_fraction']:
+        y_final, solution.pe_residual = asymptotic_extrapolation(y_final, engine.charges, engine.masses,
+                                                                 coulomb_k=engine.coulomb_k)
+    solution.y_final = y_final
+    if units!='SI':
+        solution.t = solution.t*scales['time']
+        solution.y = scale_state(solution.y, scales, to_internal=False)
+        solution.y_final = scale_state(y_final, scales, to_internal=False)
+        if solution.t_events is not None:
+            solution.t_events = [t_event*scales['time'] for t_event in solution.t_events]
+            solution.y_events = [scale_state(y_event.T, scales, to_internal=False).T if len(y_event) else y_event
+                                 for y_event in solution.y_events]
+        if 't_stop' in solution:
+            solution.t_stop = solution.t_stop*scales['time']
+        if 'pe_residual' in solution:
+            solution.pe_residual = solution.pe_residual*scales['energy']
+    return(solution)
+
+
+def make_stop_events(engine, y0, settings):
+    """Make the event functions used to stop a trajectory early, as terminal solve_ivp events that
+    stop the integration when they cross zero from above.
+
+    If settings['asymptotic_fraction'] is set, the trajectory is stopped once the Coulomb potential
+    energy falls below that fraction of the total energy. If settings['ke_convergence'] is set, the
+    trajectory is stopped once the relative change of every ion's kinetic energy over a time window of
+    settings['ke_window'], |F_i.v_i|*window/KE_i, falls below that threshold. F_i are the forces of the
+    integrator's latest force evaluation (engine.last_forces), which solve_ivp makes at the end of each step,
+    so the event adds no force evaluations and leaves the engine's diagnostics (call counts, timings, force errors)
+    untouched. Only when solve_ivp locates the stop time within the last step are the forces at the interpolated
+    states calculated, by direct summation outside the engine.
+
+    :param engine: force engine (see CoulombEngine)
+    :param y0: initial state, in the same layout as y in CESim.newton_equations
+    :param settings: dict of simulation settings (see CESim.run_sims)
+
+    :return: list of event functions event(t,y)"""
+    events = []
+    n_atoms = len(y0)//6
+    if settings['asymptotic_fraction']:
+        v0 = np.reshape(y0[3*n_atoms:], (n_atoms, 3))
+        energy_total = 0.5*np.sum(engine.masses[:, None]*v0**2) \
+            + coulomb_potential_energy(np.reshape(y0[:3*n_atoms], (n_atoms, 3)), engine.charges,
+                                       coulomb_k=engine.coulomb_k)
+
+        def asymptotic_event(t, y):
+            return(coulomb_potential_energy(np.reshape(y[:3*n_atoms], (n_atoms, 3)), engine.charges,
+                                            coulomb_k=engine.coulomb_k)
+                   - settings['asymptotic_fraction']*energy_total)
+        asymptotic_event.terminal = True
+        asymptotic_event.direction = -1
+        events.append(asymptotic_event)
+    if settings['ke_convergence']:
+        threshold = settings['ke_convergence']
+
+        def ke_convergence_event(t, y):
+            # relative change of each ion's kinetic energy over the window, from dKE_i/dt = F_i.v_i
+            positions = np.reshape(y[:3*n_atoms], (n_atoms, 3))
+            velocities = np.reshape(y[3*n_atoms:], (n_atoms, 3))
+            ke = 0.5*engine.masses*np.sum(velocities**2, axis=1)
+            t_forces, forces = engine.last_forces if engine.last_forces is not None else (None, None)
+            if forces is None or (t_forces is not None and t_forces!=t):
+                forces = coulomb_forces_on(np.arange(n_atoms), positions, engine.charges, coulomb_k=engine.coulomb_k)
+            dke_dt = np.abs(np.sum(forces*velocities, axis=1))
+            change = np.divide(dke_dt*settings['ke_window'], ke, out=np.where(dke_dt>0, np.inf, 0.), where=ke>0)
+            # capped so the event function stays finite for the root finding of solve_ivp
+            return(min(np.max(change), 1e6*threshold) - threshold)
+        ke_convergence_event.terminal = True
+        ke_convergence_event.direction = -1
+        events.append(ke_convergence_event)
+    return(events)
+
+
+# columns of the output array of each simulation (see make_output_array)
+output_columns = ['vx_ms', 'vy_ms', 'vz_ms', 'charge_C', 'mass_kg', 'channel_idx', 'sim_counter']
+
+
+def make_output_array(y_final, charges, masses, channel_idx, sim_counter):
+    """Make the output array of one simulation from its final state. Each row is an atom, with columns
+    vx, vy, vz, charge, mass, channel index and simulation number (see CESim.output_list_to_df).
+    The output of n simulations is made at once from (n,natoms*6) final states, (n,natoms) charges and masses,
+    and (n,) channel indices and simulation numbers, with the rows of each simulation in turn.
+
+    :param y_final: final positions and velocities, in the same layout as y in CESim.newton_equations
+    :param charges: array of charges (in C)
+    :param masses: array of masses (in kg)
+    :param channel_idx: index of the CE channel
+    :param sim_counter: simulation number
+
+    :return: (natoms,7) output array, or (n*natoms,7) for n simulations"""
+    charges = np.asarray(charges)
+    n_atoms = charges.shape[-1]
+    output_array = np.zeros((charges.size,7))
+    output_array[:,0:3] = np.reshape(np.asarray(y_final)[..., 3*n_atoms:6*n_atoms], (-1,3))
+    output_array[:,3] = charges.ravel()
+    output_array[:,4] = np.ravel(masses)
+    output_array[:,5] = np.repeat(channel_idx, n_atoms)
+    output_array[:,6] = np.repeat(sim_counter, n_atoms)
+    return(output_array)
+
+
+# derived output columns, as (columns they are calculated from, function of a dict of those columns)
+derived_column_dict = {'charge_e': (['charge_C'], lambda c: c['charge_C']/e),
+                       'mass_amu': (['mass_kg'], lambda c: c['mass_kg']/u),
+                       'px_SI': (['vx_ms', 'mass_kg'], lambda c: c['vx_ms']*c['mass_kg']),
+                       'py_SI': (['vy_ms', 'mass_kg'], lambda c: c['vy_ms']*c['mass_kg']),
+                       'pz_SI': (['vz_ms', 'mass_kg'], lambda c: c['vz_ms']*c['mass_kg']),
+                       'px_AU': (['px_SI'], lambda c: c['px_SI'] / p_au_fac),
+                       'py_AU': (['py_SI'], lambda c: c['py_SI'] / p_au_fac),
+                       'pz_AU': (['pz_SI'], lambda c: c['pz_SI'] / p_au_fac),
+                       'pmag_AU': (['px_AU', 'py_AU', 'pz_AU'],
+                                   lambda c: np.sqrt(c['px_AU']**2+c['py_AU']**2+c['pz_AU']**2)),
+                       'KE_eV': (['pmag_AU', 'mass_kg'],
+                                 lambda c: (c['pmag_AU']**2)/(2*c['mass_kg']/u)*p_au_KE_eV_fac)}
+
+
+def base_columns(columns):
+    """Output array columns (see output_columns) needed to calculate the given columns.
+
+    :param columns: list of output and derived (see derived_column_dict) column names
+
+    :return: list of output column names, in the order of output_columns"""
+    needed = set()
+    stack = list(columns)
+    while stack:
+        column = stack.pop()
+        if column in output_columns:
+            needed.add(column)
+        elif column in derived_column_dict:
+            stack.extend(derived_column_dict[column][0])
+        else:
+            raise ValueError(f"Unknown column {column}. Options are: {output_columns + list(derived_column_dict)}")
+    return([column for column in output_columns if column in needed])
+
+
+def compute_columns(base, columns):
+    """Calculate columns from the output array columns.
+
+    :param base: dict of output array columns (see base_columns)
+    :param columns: list of column names to return
+
+    :return: dict of the columns"""
+    values = dict(base)
+
+    def compute(column):
+        if column not in values:
+            inputs, function = derived_column_dict[column]
+            for name in inputs:
+                compute(name)
+            values[column] = function(values)
+        return(values[column])
+    return({column: compute(column) for column in columns})
+
+
+def make_output_df(output_arr):
+    """Convert an output array (rows from make_output_array) to a dataframe, with all the derived
+    columns (see derived_column_dict): charge in e, mass in u, momenta in SI and atomic units,
+    and kinetic energy in eV.
+
+    :param output_arr: (n_rows,7) output array
+
+    :return: dataframe"""
+    output_df = pd.DataFrame(output_arr, columns=output_columns)
+    derived = compute_columns({column: output_df[column] for column in output_columns}, list(derived_column_dict))
+    for column, values in derived.items():
+        output_df[column] = values
+    return(output_df)
+
+
+def filter_mask(values, selection):
+    """Boolean mask of values matching a filter of ResultsDataset.
+
+    :param values: array of values
+    :param selection: a single value, a list of values, or a range
+
+    :return: boolean array"""
+    if isinstance(selection, range):
+        mask = (values>=selection.start) & (values<selection.stop)
+        if selection.step!=1:
+            mask &= (values-selection.start)%selection.step==0
+        return(mask)
+    return(np.isin(values, np.atleast_1d(selection)))
+
+
+class ResultSink:
+    """Streaming on-disk sink for the output of CESim.run_sims (see run_sims(result_sink=...)). The output
+    arrays of completed simulations are buffered and written every shard_size simulations as a columnar shard,
+    a .npy file or (with pyarrow) a Parquet file, so only one shard is held in memory.
+
+    :param path: directory of the shards
+    :param shard_size: number of simulations per shard (default 100)
+    :param file_format: ['npy', 'parquet'] (default 'npy')"""
+    def __init__(self, path, shard_size=100, file_format='npy'):
+        if file_format not in ['npy', 'parquet']:
+            raise ValueError(f"Unknown file format {file_format}. Options are: ['npy', 'parquet']")
+        if file_format=='parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError("file_format='parquet' needs pyarrow, use file_format='npy' instead")
+        self.path = path
+        self.shard_size = shard_size
+        self.file_format = file_format
+        self.shards = []
+        self.shard_stats = []
+        self.buffer = []
+        self.n_rows = 0
+        self.n_samples = 0
+
+    def start(self):
+        """Prepare the sink for a run, removing the shards of a previous run."""
+        os.makedirs(self.path, exist_ok=True)
+        for fname in os.listdir(self.path):
+            if fname.startswith('results_') and fname.endswith(('.npy', '.parquet')):
+                os.remove(os.path.join(self.path, fname))
+        self.shards = []
+        self.shard_stats = []
+        self.buffer = []
+        self.n_rows = 0
+        self.n_samples = 0
+
+    def add(self, output_array):
+        """Add the output array (see make_output_array) of one simulation."""
+        self.buffer.append(output_array)
+        self.n_samples += 1
+        if len(self.buffer)>=self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered output to a new shard."""
+        if not self.buffer:
+            return
+        output_arr = np.vstack(self.buffer)
+        shard = f'results_{len(self.shards):05d}.{self.file_format}'
+        if self.file_format=='npy':
+            np.save(os.path.join(self.path, shard), output_arr)
+        else:
+            pd.DataFrame(output_arr, columns=output_columns).to_parquet(os.path.join(self.path, shard))
+        self.shards.append(shard)
+        # per-shard ranges, so readers can skip shards that do not match a filter (see ResultsDataset)
+        self.shard_stats.append({'sim_counter': [float(np.min(output_arr[:, 6])), float(np.max(output_arr[:, 6]))],
+                                 'channel_idx': np.unique(output_arr[:, 5]).tolist(),
+                                 'charge_e': np.unique(np.round(output_arr[:, 3]/e, 6)).tolist()})
+        self.n_rows += len(output_arr)
+        self.buffer = []
+
+    def close(self):
+        """Write any buffered output and the index of the shards."""
+        self.flush()
+        index = {'columns': output_columns, 'file_format': self.file_format, 'shards': self.shards,
+                 'shard_stats': self.shard_stats, 'n_rows': self.n_rows, 'n_samples': self.n_samples}
+        with open(os.path.join(self.path, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+    @classmethod
+    def load(cls, path):
+        """Open the shards written by a previous run.
+
+        :param path: directory of the shards
+
+        :return: ResultSink"""
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        sink = cls.__new__(cls)
+        sink.path = path
+        sink.file_format = index['file_format']
+        sink.shards = index['shards']
+        sink.shard_stats = index.get('shard_stats', [])
+        sink.n_rows = index['n_rows']
+        sink.n_samples = index['n_samples']
+        sink.buffer = []
+        return(sink)
+
+    def iter_shards(self):
+        """Iterate over the shards, reading one at a time.
+
+        :return: generator of (n_rows,7) output arrays"""
+        for shard in self.shards:
+            if self.file_format=='npy':
+                yield(np.load(os.path.join(self.path, shard)))
+            else:
+                yield(pd.read_parquet(os.path.join(self.path, shard))[output_columns].to_numpy())
+
+    def to_arr(self):
+        """Read all the shards into one output array."""
+        return(np.vstack(list(self.iter_shards())))
+
+    def to_df(self):
+        """Read all the shards into one dataframe (see make_output_df)."""
+        return(make_output_df(self.to_arr()))
+
+
+class ResultsDataset:
+    """Out-of-core view of the output shards written by a ResultSink. Only the requested columns are
+    returned, with derived columns (see derived_column_dict) calculated on demand, and the filters on channel_idx,
+    charge_e and sim_counter are applied while reading: shards that cannot match are skipped, and only the
+    matching rows of the others are kept. Shards are read one at a time, so iter_chunks works on outputs
+    larger than memory.
+
+    Filters are a single value, a list of values or (for sim_counter) a range, e.g.
+    ResultsDataset(path).to_df(['px_AU', 'KE_eV'], channel_idx=0, charge_e=[2], sim_counter=range(1000)).
+
+    :param path: directory of the shards"""
+    def __init__(self, path):
+        self.sink = ResultSink.load(path)
+
+    @property
+    def columns(self):
+        """Names of all the available columns."""
+        return(output_columns + list(derived_column_dict))
+
+    def __len__(self):
+        return(self.sink.n_rows)
+
+    def shard_matches(self, stats, filters):
+        """Whether a shard may contain rows matching the filters, from its stats (see ResultSink.flush)."""
+        if not stats:
+            return(True)
+        for column, selection in filters.items():
+            if column=='sim_counter':
+                lo, hi = stats['sim_counter']
+                candidates = np.arange(lo, hi+1)
+            else:
+                candidates = np.array(stats[column])
+            if not np.any(filter_mask(candidates, selection)):
+                return(False)
+        return(True)
+
+    def read_shard(self, shard, columns, filters):
+        """Read the rows of one shard matching the filters.
+
+        :return: dict of the output array columns in columns"""
+        fname = os.path.join(self.sink.path, shard)
+        if self.sink.file_format=='npy':
+            arr = np.load(fname, mmap_mode='r')
+            mask = np.ones(len(arr), dtype=bool)
+            for column, selection in filters.items():
+                if column=='charge_e':
+                    mask &= filter_mask(np.round(arr[:, 3]/e, 6), selection)
+                else:
+                    mask &= filter_mask(arr[:, output_columns.index(column)], selection)
+            rows = np.nonzero(mask)[0]
+            return({column: np.array(arr[rows, output_columns.index(column)]) for column in columns})
+        parquet_filters = []
+        for column, selection in filters.items():
+            if column=='channel_idx' or (column=='sim_counter' and not isinstance(selection, range)):
+                parquet_filters.append((column, 'in', [float(value) for value in np.atleast_1d(selection)]))
+            elif column=='sim_counter':
+                parquet_filters += [(column, '>=', float(selection.start)), (column, '<', float(selection.stop))]
+        read_columns = list(columns)
+        if 'charge_e' in filters and 'charge_C' not in read_columns:
+            read_columns.append('charge_C')
+        if 'sim_counter' in filters and 'sim_counter' not in read_columns:
+            read_columns.append('sim_counter')
+        table = pd.read_parquet(fname, columns=read_columns, filters=parquet_filters if parquet_filters else None)
+        mask = np.ones(len(table), dtype=bool)
+        if 'charge_e' in filters:
+            mask &= filter_mask(np.round(table['charge_C'].to_numpy()/e, 6), filters['charge_e'])
+        if isinstance(filters.get('sim_counter'), range):
+            mask &= filter_mask(table['sim_counter'].to_numpy(), filters['sim_counter'])
+        return({column: table[column].to_numpy()[mask] for column in columns})
+
+    def iter_chunks(self, columns=None, channel_idx=None, charge_e=None, sim_counter=None):
+        """Iterate over the matching rows, one shard at a time.
+
+        :param columns: list of column names (default all, see self.columns)
+        :param channel_idx: filter on the channel index
+        :param charge_e: filter on the charge (in e)
+        :param sim_counter: filter on the simulation number
+
+        :return: generator of dataframes"""
+        columns = self.columns if columns is None else list(columns)
+        base = base_columns(columns)
+        filters = {column: selection for column, selection in
+                   [('channel_idx', channel_idx), ('charge_e', charge_e), ('sim_counter', sim_counter)]
+                   if selection is not None}
+        stats_list = self.sink.shard_stats if self.sink.shard_stats else [None]*len(self.sink.shards)
+        for shard, stats in zip(self.sink.shards, stats_list):
+            if not self.shard_matches(stats, filters):
+                continue
+            chunk = compute_columns(self.read_shard(shard, base, filters), columns)
+            if len(chunk[columns[0]]):
+                yield(pd.DataFrame(chunk, columns=columns))
+
+    def to_df(self, columns=None, channel_idx=None, charge_e=None, sim_counter=None):
+        """Read the matching rows into one dataframe. See iter_chunks for the parameters."""
+        chunks = list(self.iter_chunks(columns, channel_idx=channel_idx, charge_e=charge_e, sim_counter=sim_counter))
+        if not chunks:
+            return(pd.DataFrame(columns=self.columns if columns is None else list(columns)))
+        return(pd.concat(chunks, ignore_index=True))
+
+
+def solution_diagnostics(solution):
+    """Collect the diagnostics of one integrated trajectory (energy drift, stop time and
+    potential energy added analytically), where available.
+
+    :param solution: result from integrate_trajectory
+
+    :return: dict of diagnostics"""
+    return({key: solution[key] for key in ('energy_drift', 't_stop', 'pe_residual') if key in solution})
+
+
+def select_trajectory(t, y, atoms=None, decimate=1, n_grid=None):
+    """Select part of a trajectory for recording: every decimate-th time (and the last time of the grid)
+    and the given atoms.
+
+    :param t: array of times
+    :param y: (natoms*6,len(t)) array of states, in the same layout as y in CESim.newton_equations
+    :param atoms: list of atom indices to keep (default all)
+    :param decimate: keep every decimate-th time (default 1)
+    :param n_grid: number of times in the full time grid, if t is cut short by early stopping (default len(t))
+
+    :return: (array of selected times, (n_times,n_atoms,6) array of x, y, z, vx, vy, vz of the selected atoms)"""
+    n_grid = len(t) if n_grid is None else n_grid
+    t_idx = np.nonzero((np.arange(len(t))%decimate==0) | (np.arange(len(t))==n_grid-1))[0]
+    n_atoms = y.shape[0]//6
+    atoms = np.arange(n_atoms) if atoms is None else np.asarray(atoms)
+    positions = y[:3*n_atoms, t_idx].reshape(n_atoms, 3, -1)[atoms]
+    velocities = y[3*n_atoms:, t_idx].reshape(n_atoms, 3, -1)[atoms]
+    return(np.asarray(t)[t_idx], np.concatenate((positions, velocities), axis=1).transpose(2, 0, 1))
+
+
+class TrajectoryStore:
+    """On-disk store of recorded trajectories (see CESim.run_sims(trajectory_store=...)), decimated in time,
+    for selected atoms and in float32.
+
+    With backend='npz' the trajectories are written in compressed .npz shards of shard_size trajectories,
+    optionally delta encoded along time (which compresses better), and each trajectory may have its own length.
+    With backend='memmap' they are written to a single (n_samples,n_times,n_atoms,6) memory-mapped .npy file,
+    where times after the end of a trajectory stopped early are NaN, so one atom across all trajectories
+    is a strided read. In both cases a trajectory or an atom is read without loading the rest of the store.
+
+    :param path: directory of the store
+    :param atoms: list of atom indices to record (default all)
+    :param decimate: record every decimate-th time step (default 1). The last time is always kept
+    :param delta_encode: if True, store the first time and then the differences between times (npz only). The
+    differences are taken between the float32 values as integers (their bit patterns), so decoding is exact
+    :param shard_size: number of trajectories per .npz shard (default 100)
+    :param backend: ['npz', 'memmap'] (default 'npz')"""
+    def __init__(self, path, atoms=None, decimate=1, delta_encode=False, shard_size=100, backend='npz'):
+        if backend not in ['npz', 'memmap']:
+            raise ValueError(f"Unknown backend {backend}. Options are: ['npz', 'memmap']")
+        if delta_encode and backend=='memmap':
+            raise ValueError("delta_encode is only available for backend='npz'")
+        self.path = path
+        self.atoms = None if atoms is None else [int(atom) for atom in atoms]
+        self.decimate = decimate
+        self.delta_encode = delta_encode
+        self.shard_size = shard_size
+        self.backend = backend
+        self.n_grid = None
+        self.shard_index = {}
+        self.n_shards = 0
+        self.n_times = {}
+        self.buffer = {}
+
+    @property
+    def selection(self):
+        """Keyword arguments of select_trajectory for this store."""
+        return({'atoms': self.atoms, 'decimate': self.decimate, 'n_grid': self.n_grid})
+
+    def start(self, n_samples, timebins):
+        """Prepare the store for a run, removing the trajectories of a previous run.
+
+        :param n_samples: number of trajectories
+        :param timebins: times at which the trajectories are evaluated"""
+        os.makedirs(self.path, exist_ok=True)
+        for fname in os.listdir(self.path):
+            if (fname.startswith('shard_') and fname.endswith('.npz')) or fname in ['trajectories.npy', 't.npy',
+                                                                                     'index.json']:
+                os.remove(os.path.join(self.path, fname))
+        self.shard_index = {}
+        self.n_shards = 0
+        self.n_times = {}
+        self.buffer = {}
+        self.memmap = None
+        self.n_grid = len(timebins)
+        self.n_samples = n_samples
+        if self.backend=='memmap':
+            # the atom count is only known from the first trajectory, so the file is created in add
+            self.t_grid = select_trajectory(timebins, np.zeros((6, len(timebins))), decimate=self.decimate)[0]
+            np.save(os.path.join(self.path, 't.npy'), self.t_grid)
+
+    def add(self, sim_counter, t, traj):
+        """Write one trajectory, as selected by select_trajectory.
+
+        :param sim_counter: simulation number
+        :param t: array of times
+        :param traj: (len(t),n_atoms,6) array"""
+        self.n_times[int(sim_counter)] = len(t)
+        if self.backend=='memmap':
+            if self.memmap is None:
+                shape = (self.n_samples, len(self.t_grid), traj.shape[1], 6)
+                self.memmap = np.lib.format.open_memmap(os.path.join(self.path, 'trajectories.npy'), mode='w+',
+                                                        dtype=np.float32, shape=shape)
+            self.memmap[sim_counter, :len(t)] = traj
+            self.memmap[sim_counter, len(t):] = np.nan
+            return
+        traj = np.ascontiguousarray(traj, dtype=np.float32)
+        if self.delta_encode:
+            # integer differences (wrapping on overflow) of the float32 bit patterns, so the cumulative sum in
+            # decode gives back exactly the stored values, with no rounding error building up along the trajectory
+            bits = traj.view(np.int32)
+            traj = np.concatenate((bits[:1], np.diff(bits, axis=0)))
+        self.buffer[f't_{sim_counter}'] = np.asarray(t)
+        self.buffer[f'y_{sim_counter}'] = traj
+        if len(self.buffer)//2>=self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered trajectories to a new .npz shard."""
+        if not self.buffer:
+            return
+        shard = f'shard_{self.n_shards:05d}.npz'
+        self.n_shards += 1
+        np.savez_compressed(os.path.join(self.path, shard), **self.buffer)
+        for key in self.buffer:
+            if key.startswith('t_'):
+                self.shard_index[int(key[2:])] = shard
+        self.buffer = {}
+
+    def close(self):
+        """Write any buffered trajectories and the index of the store."""
+        if self.backend=='memmap':
+            if self.memmap is not None:
+                self.memmap.flush()
+                self.memmap = None
+        else:
+            self.flush()
+        index = {'atoms': self.atoms, 'decimate': self.decimate, 'delta_encode': self.delta_encode,
+                 'backend': self.backend, 'n_times': self.n_times, 'shard_index': self.shard_index}
+        with open(os.path.join(self.path, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+    @classmethod
+    def load(cls, path):
+        """Open an existing store for reading.
+
+        :param path: directory of the store
+
+        :return: TrajectoryStore"""
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        store = cls(path, atoms=index['atoms'], decimate=index['decimate'], delta_encode=index['delta_encode'],
+                    backend=index['backend'])
+        store.n_times = {int(key): value for key, value in index['n_times'].items()}
+        store.shard_index = {int(key): value for key, value in index['shard_index'].items()}
+        return(store)
+
+    @property
+    def sim_counters(self):
+        """Sorted simulation numbers in the store."""
+        return(sorted(self.n_times))
+
+    def atom_column(self, atom):
+        """Column of an atom (index in the original geometry) in the stored arrays."""
+        if self.atoms is None:
+            return(atom)
+        if atom not in self.atoms:
+            raise ValueError(f"Atom {atom} was not recorded. Recorded atoms are: {self.atoms}")
+        return(self.atoms.index(atom))
+
+    def decode(self, traj):
+        """Convert a stored trajectory array back to float64 positions and velocities."""
+        if self.delta_encode and np.issubdtype(traj.dtype, np.integer):
+            return(np.cumsum(traj, axis=0, dtype=np.int32).view(np.float32).astype(float))
+        if self.delta_encode:
+            # stores written before the integer encoding hold float32 differences
+            return(np.cumsum(traj, axis=0, dtype=float))
+        return(traj.astype(float))
+
+    def get_trajectory(self, sim_counter):
+        """Read one trajectory.
+
+        :param sim_counter: simulation number
+
+        :return: (array of times, (n_times,n_atoms,6) array of x, y, z (in m), vx, vy, vz (in m/s))"""
+        n_times = self.n_times[sim_counter]
+        if self.backend=='memmap':
+            t = np.load(os.path.join(self.path, 't.npy'))
+            trajectories = np.load(os.path.join(self.path, 'trajectories.npy'), mmap_mode='r')
+            return(t[:n_times], np.array(trajectories[sim_counter, :n_times], dtype=float))
+        with np.load(os.path.join(self.path, self.shard_index[sim_counter])) as shard:
+            return(shard[f't_{sim_counter}'], self.decode(shard[f'y_{sim_counter}']))
+
+    def iter_trajectories(self):
+        """Iterate over the trajectories, reading one shard at a time.
+
+        :return: generator of (sim_counter, array of times, (n_times,n_atoms,6) array)"""
+        if self.backend=='memmap':
+            for sim_counter in self.sim_counters:
+                yield((sim_counter,) + self.get_trajectory(sim_counter))
+            return
+        for shard_name in sorted(set(self.shard_index.values())):
+            with np.load(os.path.join(self.path, shard_name)) as shard:
+                for sim_counter in sorted(key for key, value in self.shard_index.items() if value==shard_name):
+                    yield(sim_counter, shard[f't_{sim_counter}'], self.decode(shard[f'y_{sim_counter}']))
+
+    def get_atom(self, atom):
+        """Read one atom across all trajectories.
+
+        :param atom: atom index in the original geometry
+
+        :return: (list of arrays of times, list of (n_times,6) arrays), in order of sim_counter.
+        For backend='memmap', (array of times, (n_samples,n_times,6) array, NaN after the end of a trajectory)"""
+        column = self.atom_column(atom)
+        if self.backend=='memmap':
+            t = np.load(os.path.join(self.path, 't.npy'))
+            trajectories = np.load(os.path.join(self.path, 'trajectories.npy'), mmap_mode='r')
+            return(t, np.array(trajectories[:, :, column], dtype=float))
+        t_list, traj_list = [], []
+        for sim_counter, t, traj in self.iter_trajectories():
+            t_list.append(t)
+            traj_list.append(traj[:, column])
+        return(t_list, traj_list)
+
+
+class HistogramAccumulator:
+    """Fixed-size histogram of output columns (see output_columns and derived_column_dict), updated with
+    the final state of each simulation during a run (see CESim.add_accumulator), so the memory used does
+    not grow with the number of simulations. Accumulators with the same bins can be merged, e.g. from
+    the worker processes of CESim.run_parallel.
+
+    :param columns: list of 1 to 3 column names, e.g. ['px_AU', 'py_AU']
+    :param bins: number of bins, for all columns or as a list with one per column
+    :param ranges: (min,max) for all columns or as a list with one per column
+    :param by: optional column to keep a separate histogram for each value of, e.g. 'charge_e' or 'mass_amu'
+    :param select: optional dict of filters (see filter_mask) on columns, e.g. {'channel_idx': 0}"""
+    def __init__(self, columns, bins=100, ranges=None, by=None, select=None):
+        self.columns = list(columns)
+        if not 1<=len(self.columns)<=3:
+            raise ValueError("Histograms are 1D, 2D or 3D")
+        if ranges is None:
+            raise ValueError("Fixed-size histograms need ranges")
+        bins = bins if np.ndim(bins) else [bins]*len(self.columns)
+        ranges = ranges if np.ndim(ranges)==2 else [ranges]*len(self.columns)
+        self.edges = [np.linspace(lo, hi, n_bins+1) for n_bins, (lo, hi) in zip(bins, ranges)]
+        self.by = by
+        self.select = select if select else {}
+        self.needed = base_columns(self.columns + ([by] if by else []) + list(self.select))
+        self.reset()
+
+    def reset(self):
+        """Set all counts to zero."""
+        self.counts = {}
+        self.n_entries = 0
+
+    def empty_copy(self):
+        """Accumulator with the same bins and no counts."""
+        copy = HistogramAccumulator.__new__(type(self))
+        copy.__dict__.update(self.__dict__)
+        copy.reset()
+        return(copy)
+
+    def update(self, output_array):
+        """Add the rows of an output array (see make_output_array)."""
+        base = {column: output_array[:, output_columns.index(column)] for column in self.needed}
+        values = compute_columns(base, self.columns + ([self.by] if self.by else []) + list(self.select))
+        mask = np.ones(len(output_array), dtype=bool)
+        for column, selection in self.select.items():
+            mask &= filter_mask(np.round(values[column], 6), selection)
+        sample = np.column_stack([values[column][mask] for column in self.columns])
+        groups = np.round(values[self.by][mask], 6) if self.by else np.zeros(len(sample))
+        for group in np.unique(groups):
+            counts = np.histogramdd(sample[groups==group], bins=self.edges)[0].astype(np.int64)
+            key = float(group) if self.by else None
+            self.counts[key] = self.counts[key] + counts if key in self.counts else counts
+        self.n_entries += len(sample)
+
+    def merge(self, other):
+        """Add the counts of another accumulator with the same bins."""
+        if self.columns!=other.columns or self.by!=other.by or \
+                any(not np.array_equal(a, b) for a, b in zip(self.edges, other.edges)):
+            raise ValueError("Only accumulators with the same columns and bins can be merged")
+        for key, counts in other.counts.items():
+            self.counts[key] = self.counts[key] + counts if key in self.counts else counts.copy()
+        self.n_entries += other.n_entries
+
+    def histogram(self, group=None):
+        """Counts of one group (see by), or of all groups together if group is None.
+
+        :return: array of counts, with one axis per column"""
+        if group is not None:
+            return(self.counts.get(float(group), np.zeros([len(edges)-1 for edges in self.edges], dtype=np.int64)))
+        total = np.zeros([len(edges)-1 for edges in self.edges], dtype=np.int64)
+        for counts in self.counts.values():
+            total += counts
+        return(total)
+
+    @property
+    def groups(self):
+        """Sorted values of the by column that have counts."""
+        return(sorted(key for key in self.counts if key is not None))
+
+
+class KESpectrum(HistogramAccumulator):
+    """Kinetic energy spectrum, by default for each charge state.
+
+    :param bins: number of bins (default 200)
+    :param ke_range: (min,max) kinetic energy (in eV)
+    :param by: column to keep a separate spectrum for each value of (default 'charge_e')
+    :param select: optional dict of filters on columns"""
+    def __init__(self, bins=200, ke_range=(0, 100), by='charge_e', select=None):
+        HistogramAccumulator.__init__(self, ['KE_eV'], bins=bins, ranges=ke_range, by=by, select=select)
+
+
+class MomentumHistogram(HistogramAccumulator):
+    """1D, 2D or 3D histogram of momentum components (in atomic units), by default for each mass.
+
+    :param components: components to histogram, from 'x', 'y' and 'z' (default 'xyz')
+    :param bins: number of bins per component (default 100)
+    :param p_range: (min,max) momentum (in a.u.)
+    :param by: column to keep a separate histogram for each value of (default 'mass_amu')
+    :param select: optional dict of filters on columns"""
+    def __init__(self, components='xyz', bins=100, p_range=(-200, 200), by='mass_amu', select=None):
+        HistogramAccumulator.__init__(self, [f'p{component}_AU' for component in components], bins=bins,
+                                      ranges=p_range, by=by, select=select)
+
+
+class VMIImage(HistogramAccumulator):
+    """Velocity map image: 2D histogram of the velocity projected onto the detector plane,
+    e.g. as input to an inverse Abel transform (see Examples/pyabel.ipynb).
+
+    :param axis: ['x', 'y', 'z'] spectrometer axis, perpendicular to the detector (default 'z')
+    :param bins: number of bins per dimension (default 200)
+    :param v_max: maximum velocity (in m/s), the image covers -v_max to v_max
+    :param by: optional column to keep a separate image for each value of, e.g. 'mass_amu'
+    :param select: optional dict of filters on columns, e.g. {'charge_e': 1}"""
+    def __init__(self, axis='z', bins=200, v_max=5e4, by=None, select=None):
+        plane = [component for component in 'xyz' if component!=axis]
+        HistogramAccumulator.__init__(self, [f'v{component}_ms' for component in plane], bins=bins,
+                                      ranges=(-v_max, v_max), by=by, select=select)
+
+
+def shot_columns(shots, columns):
+    """Output and derived columns (see derived_column_dict) of a stack of shots.
+
+    :param shots: (n_shots,natoms,7) array, the output arrays (see make_output_array) of n_shots simulations
+    :param columns: list of column names
+
+    :return: dict of (n_shots,natoms) arrays"""
+    base = {column: shots[:, :, output_columns.index(column)] for column in base_columns(columns)}
+    return(compute_columns(base, columns))
+
+
+def iter_shots(source, natoms=None, chunk_size=10000):
+    """Iterate over the output of a run in chunks of shots (simulations), each as a (n_shots,natoms,7) array.
+
+    :param source: output array (e.g. CESim.output_arr), ResultsDataset or directory of a ResultSink
+    :param natoms: number of atoms per simulation (default from the first simulation)
+    :param chunk_size: max number of shots per chunk (default 10000)
+
+    :return: generator of (n_shots,natoms,7) arrays"""
+    if isinstance(source, str):
+        source = ResultsDataset(source)
+    if isinstance(source, ResultsDataset):
+        arrays = (chunk.to_numpy() for chunk in source.iter_chunks(output_columns))
+    else:
+        arrays = [np.asarray(source)]
+    remainder = None
+    for arr in arrays:
+        if remainder is not None:
+            arr = np.vstack((remainder, arr))
+        if natoms is None:
+            natoms = int(np.sum(arr[:, 6]==arr[0, 6]))
+        n_shots = len(arr)//natoms
+        shots = arr[:n_shots*natoms].reshape(n_shots, natoms, len(output_columns))
+        if not np.all(shots[:, :, 6]==shots[:, :1, 6]):
+            raise ValueError("The output is not in blocks of natoms rows per simulation")
+        remainder = arr[n_shots*natoms:]
+        for start in range(0, n_shots, chunk_size):
+            yield(shots[start:start+chunk_size])
+    if remainder is not None and len(remainder):
+        raise ValueError("The output is not in blocks of natoms rows per simulation")
+
+
+def analyse_shots(source, accumulators, natoms=None, chunk_size=10000):
+    """Update shot accumulators (e.g. CovarianceMap, NewtonDiagram, PairDistribution) with the output
+    of a run, in chunks of shots (see iter_shots).
+
+    :param source: output array (e.g. CESim.output_arr), ResultsDataset or directory of a ResultSink
+    :param accumulators: list of accumulators
+    :param natoms: number of atoms per simulation (default from the first simulation)
+    :param chunk_size: max number of shots per chunk (default 10000)
+
+    :return: the list of accumulators"""
+    for shots in iter_shots(source, natoms=natoms, chunk_size=chunk_size):
+        for accumulator in accumulators:
+            accumulator.update_shots(shots)
+    return(accumulators)
+
+
+def shot_histograms(values, valid, edges):
+    """Histogram of the values of each shot.
+
+    :param values: (n_shots,n_ions) array of values
+    :param valid: (n_shots,n_ions) boolean array of the ions to include
+    :param edges: bin edges
+
+    :return: (n_shots,n_bins) array of counts"""
+    n_bins = len(edges)-1
+    bin_idx = np.searchsorted(edges, values, side='right')-1
+    bin_idx[values==edges[-1]] = n_bins-1
+    valid = valid & (bin_idx>=0) & (bin_idx<n_bins)
+    shot_idx = np.broadcast_to(np.arange(len(values))[:, None], values.shape)
+    counts = np.bincount((shot_idx*n_bins+bin_idx)[valid], minlength=len(values)*n_bins)
+    return(counts.reshape(len(values), n_bins).astype(float))
+
+
+class ShotAccumulator:
+    """Base class for accumulators of correlations between the ions of each shot (simulation). They are
+    updated with chunks of shots by update_shots (see analyse_shots), or with one simulation at a time when
+    registered on a CESim (see CESim.add_accumulator), and accumulators with the same settings can be merged.
+    Subclasses implement update_shots, adding to the arrays in self.sums.
+
+    :param select: optional dict of filters (see filter_mask) on columns of each ion, e.g. {'charge_e': 1}"""
+    def __init__(self, select=None):
+        self.select = select if select else {}
+        self.reset()
+
+    def reset(self):
+        """Set all sums to zero."""
+        self.sums = {}
+        self.n_shots = 0
+
+    def empty_copy(self):
+        """Accumulator with the same settings and no counts."""
+        copy = ShotAccumulator.__new__(type(self))
+        copy.__dict__.update(self.__dict__)
+        copy.reset()
+        return(copy)
+
+    def add(self, name, value):
+        """Add value to the sum called name."""
+        self.sums[name] = self.sums[name] + value if name in self.sums else value
+
+    def update(self, output_array):
+        """Add one simulation, from its output array (see make_output_array)."""
+        self.update_shots(output_array[None])
+
+    def merge(self, other):
+        """Add the sums of another accumulator with the same settings."""
+        if type(self) is not type(other) or \
+                any(not np.array_equal(a, b) for a, b in zip(self.edges, other.edges)):
+            raise ValueError("Only accumulators with the same settings can be merged")
+        for name, value in other.sums.items():
+            self.add(name, value)
+        self.n_shots += other.n_shots
+
+    def ion_mask(self, shots, atoms):
+        """(n_shots,len(atoms)) boolean array of the ions passing the select filters."""
+        mask = np.ones((len(shots), len(atoms)), dtype=bool)
+        if self.select:
+            values = shot_columns(shots[:, atoms], list(self.select))
+            for column, selection in self.select.items():
+                mask &= filter_mask(np.round(values[column], 6), selection)
+        return(mask)
+
+
+class CovarianceMap(ShotAccumulator):
+    """Covariance and coincidence maps of one column (e.g. a momentum component) between two groups of ions.
+    For each shot, the values of each group are histogrammed, and the sums of the histograms and of their outer
+    products are accumulated, so the covariance <h_a h_b> - <h_a><h_b> needs no grouping of the output rows.
+    Pairs of an ion with itself (if the groups overlap) are excluded.
+
+    :param column: column name, e.g. 'pz_AU' (see output_columns and derived_column_dict)
+    :param atoms_a: atom indices of the first group
+    :param atoms_b: atom indices of the second group (default atoms_a)
+    :param bins: number of bins (default 100)
+    :param value_range: (min,max) of the column
+    :param select: optional dict of filters on columns of each ion"""
+    def __init__(self, column, atoms_a, atoms_b=None, bins=100, value_range=(-200, 200), select=None):
+        self.column = column
+        self.atoms_a = np.atleast_1d(atoms_a)
+        self.atoms_b = self.atoms_a if atoms_b is None else np.atleast_1d(atoms_b)
+        self.atoms_ab = np.intersect1d(self.atoms_a, self.atoms_b)
+        self.edges = [np.linspace(value_range[0], value_range[1], bins+1)]
+        ShotAccumulator.__init__(self, select=select)
+
+    def group_histograms(self, shots, atoms):
+        values = shot_columns(shots[:, atoms], [self.column])[self.column]
+        return(shot_histograms(values, self.ion_mask(shots, atoms), self.edges[0]))
+
+    def update_shots(self, shots):
+        """Add a (n_shots,natoms,7) array of shots."""
+        h_a = self.group_histograms(shots, self.atoms_a)
+        h_b = self.group_histograms(shots, self.atoms_b)
+        self.add('a', h_a.sum(axis=0))
+        self.add('b', h_b.sum(axis=0))
+        ab = h_a.T @ h_b
+        if len(self.atoms_ab):
+            ab -= np.diag(self.group_histograms(shots, self.atoms_ab).sum(axis=0))
+        self.add('ab', ab)
+        self.n_shots += len(shots)
+
+    def coincidence(self):
+        """(n_bins,n_bins) coincidence map: counts of pairs of ions from the two groups in the same shot."""
+        return(self.sums['ab'])
+
+    def covariance(self):
+        """(n_bins,n_bins) covariance map, <h_a h_b> - <h_a><h_b> over the shots."""
+        return(self.sums['ab']/self.n_shots - np.outer(self.sums['a'], self.sums['b'])/self.n_shots**2)
+
+
+class NewtonDiagram(ShotAccumulator):
+    """Newton diagram: momenta of ions in the frame of a reference ion. For each shot the x axis is along
+    the momentum of ref_atom, and the y axis is in the plane of ref_atom and ref2_atom, with ref2_atom below
+    the x axis. The momenta of the other ions, projected onto this plane, are accumulated in a 2D histogram.
+    Shots where the frame is undefined (a neutral or zero momentum ref_atom, or ref2_atom with no momentum
+    perpendicular to it) add no counts.
+
+    :param ref_atom: atom index of the reference ion
+    :param ref2_atom: atom index of the ion defining the plane
+    :param atoms: atom indices of the ions to plot (default all except ref_atom and ref2_atom)
+    :param bins: number of bins per axis (default 200)
+    :param p_range: (min,max) momentum (in a.u.), or relative to |p_ref| if normalize
+    :param normalize: if True, divide the momenta by the magnitude of the reference momentum
+    :param select: optional dict of filters on columns of each plotted ion"""
+    def __init__(self, ref_atom, ref2_atom, atoms=None, bins=200, p_range=(-200, 200), normalize=False,
+                 select=None):
+        self.ref_atom = ref_atom
+        self.ref2_atom = ref2_atom
+        self.atoms = None if atoms is None else np.atleast_1d(atoms)
+        self.normalize = normalize
+        self.edges = [np.linspace(p_range[0], p_range[1], bins+1)]*2
+        ShotAccumulator.__init__(self, select=select)
+
+    def update_shots(self, shots):
+        """Add a (n_shots,natoms,7) array of shots."""
+        atoms = self.atoms if self.atoms is not None else \
+            np.setdiff1d(np.arange(shots.shape[1]), [self.ref_atom, self.ref2_atom])
+        columns = shot_columns(shots, ['px_AU', 'py_AU', 'pz_AU'])
+        p = np.stack([columns['px_AU'], columns['py_AU'], columns['pz_AU']], axis=-1)
+        p_ref_mag = np.linalg.norm(p[:, self.ref_atom], axis=1)
+        x_axis = np.divide(p[:, self.ref_atom], p_ref_mag[:, None], out=np.zeros((len(p), 3)),
+                           where=p_ref_mag[:, None]>0)
+        p2 = p[:, self.ref2_atom]
+        y_axis = p2 - np.sum(p2*x_axis, axis=1)[:, None]*x_axis
+        y_mag = np.linalg.norm(y_axis, axis=1)
+        y_axis = -np.divide(y_axis, y_mag[:, None], out=np.zeros((len(p), 3)), where=y_mag[:, None]>0)
+        valid = (p_ref_mag>0) & (y_mag>0)
+        px = np.einsum('sik,sk->si', p[:, atoms], x_axis)
+        py = np.einsum('sik,sk->si', p[:, atoms], y_axis)
+        if self.normalize:
+            scale = np.where(valid, p_ref_mag, 1.)[:, None]
+            px, py = px/scale, py/scale
+        mask = self.ion_mask(shots, atoms) & valid[:, None]
+        self.add('counts', np.histogram2d(px[mask], py[mask], bins=self.edges)[0])
+        self.n_shots += len(shots)
+
+    def histogram(self):
+        """(n_bins,n_bins) histogram of (p_x, p_y) in the frame of the reference ion."""
+        return(self.sums['counts'])
+
+
+class PairDistribution(ShotAccumulator):
+    """Distributions of the angle between the momenta of each pair of ions in a shot, the kinetic energy
+    release (KER) of each pair (KE_i + KE_j), their 2D distribution, and the total KER of each shot.
+    Pairs with a neutral or zero momentum ion have no angle, so they are left out of all the pair
+    distributions (but their KE still counts in the total KER).
+
+    :param atoms: atom indices of the ions (default all)
+    :param angle_bins: number of angle bins, from 0 to 180 degrees (default 180)
+    :param ker_bins: number of KER bins (default 200)
+    :param ker_range: (min,max) pair KER (in eV)
+    :param total_ker_range: (min,max) total KER of a shot (in eV)
+    :param select: optional dict of filters on columns of each ion"""
+    def __init__(self, atoms=None, angle_bins=180, ker_bins=200, ker_range=(0, 100), total_ker_range=(0, 200),
+                 select=None):
+        self.atoms = None if atoms is None else np.atleast_1d(atoms)
+        self.edges = [np.linspace(0, 180, angle_bins+1), np.linspace(ker_range[0], ker_range[1], ker_bins+1),
+                      np.linspace(total_ker_range[0], total_ker_range[1], ker_bins+1)]
+        ShotAccumulator.__init__(self, select=select)
+
+    def update_shots(self, shots):
+        """Add a (n_shots,natoms,7) array of shots."""
+        atoms = np.arange(shots.shape[1]) if self.atoms is None else self.atoms
+        columns = shot_columns(shots[:, atoms], ['px_AU', 'py_AU', 'pz_AU', 'KE_eV'])
+        p = np.stack([columns['px_AU'], columns['py_AU'], columns['pz_AU']], axis=-1)
+        ke = columns['KE_eV']
+        mask = self.ion_mask(shots, atoms)
+        i, j = np.triu_indices(len(atoms), 1)
+        p_mag = np.linalg.norm(p, axis=2)
+        valid = (p_mag[:, i]>0) & (p_mag[:, j]>0)
+        cos_angle = np.divide(np.einsum('spk,spk->sp', p[:, i], p[:, j]), p_mag[:, i]*p_mag[:, j],
+                              out=np.zeros(valid.shape), where=valid)
+        angle = np.degrees(np.arccos(np.clip(cos_angle, -1, 1)))
+        pair_ker = ke[:, i] + ke[:, j]
+        pair_mask = mask[:, i] & mask[:, j] & valid
+        self.add('angle', np.histogram(angle[pair_mask], bins=self.edges[0])[0])
+        self.add('pair_ker', np.histogram(pair_ker[pair_mask], bins=self.edges[1])[0])
+        self.add('angle_ker', np.histogram2d(angle[pair_mask], pair_ker[pair_mask], bins=self.edges[:2])[0])
+        self.add('total_ker', np.histogram(np.sum(np.where(mask, ke, 0), axis=1), bins=self.edges[2])[0])
+        self.n_shots += len(shots)
+
+
+def sample_pool_block(pool, n_geoms, seed, block):
+    """Sample one block of a pool, from its own random number stream (see make_rng). Used by the worker
+    processes of StartingConditions.generate_pool(n_workers=...).
+
+    :param pool: StartingConditions with the settings of the pool (see StartingConditions.sampler_copy)
+    :param n_geoms: number of samples in the block
+    :param seed: seed of the pool
+    :param block: block number
+
+    :return: see StartingConditions.sample_chunk"""
+    return(pool.sample_chunk(n_geoms, rng=make_rng(seed, block)))
+
+
+def run_sim_chunk(samples, settings):
+    """Simulate a chunk of starting conditions. Used by the worker processes of CESim.run_parallel,
+    so all the state of each sample is passed in explicitly.
+
+    :param samples: list of (sim_counter, y0, charges, masses, channel_idx) tuples
+    :param settings: dict of simulation settings (see CESim.run_sims)
+
+    :return: (list of (sim_counter, output array or None, force errors, force timings, diagnostics
+    (see solution_diagnostics), solution or None, selected trajectory (see select_trajectory) or None) tuples,
+    dict of accumulators (see HistogramAccumulator) updated with the chunk)"""
+    results = []
+    accumulators = {name: accumulator.empty_copy() for name, accumulator in settings['accumulators'].items()}
+    for sim_counter, y0, charges, masses, channel_idx in samples:
+        engine = make_engine(charges, masses, settings)
+        solution = integrate_trajectory(engine.newton_equations, engine, y0, settings)
+        output_array = make_output_array(solution.y_final, charges, masses, channel_idx, sim_counter)
+        for accumulator in accumulators.values():
+            accumulator.update(output_array)
+        selection = settings['trajectory_selection']
+        results.append((sim_counter, output_array if settings['keep_output'] else None,
+                        getattr(engine, 'force_errors', None),
+                        getattr(engine, 'timings', None), solution_diagnostics(solution),
+                        solution if settings['save_all'] else None,
+                        select_trajectory(solution.t, solution.y, **selection) if selection else None))
+    return(results, accumulators)
+
+
 class CESim:
     """Class for CE simulation results and methods.
     :param starting_conditions:"""
     def __init__(self, starting_conditions):
         self.starting_conditions=starting_conditions
+        self.accumulators={}
 
     def make_timebins(self, t_range_list, n_step_list):
         """Create timebins for simulation.
@@ -787,28 +3571,94 @@ class CESim:
 
     def store_output(self, solution):
         """Take solution from ODE solver and convert to output (stored in self.output_list)."""
-        charges = self.starting_conditions.samp_charges_list[self.sim_counter]
-        masses = self.starting_conditions.samp_masses_list[self.sim_counter]
-        
-
-        n_atoms = len(charges)
-        
-        output_array = np.zeros((n_atoms,7))
-        for i in range(int(n_atoms)):
-            final_v = np.array([solution.y[int((n_atoms+i)*3), self.n_t_steps-1], 
-                               solution.y[int((n_atoms+i)*3+1), self.n_t_steps-1],
-                               solution.y[int((n_atoms+i)*3+2), self.n_t_steps-1]])
-
-            output_array[i,0:3] = final_v
-            output_array[i,3] = charges[i]
-            output_array[i,4] = masses[i]
-            if len(self.starting_conditions.samp_channel_list):
-                output_array[i,5] = self.starting_conditions.samp_channel_list[self.sim_counter].index
-            else:
-                output_array[i,5]=0
-            output_array[i,6] = self.sim_counter
-
-        self.output_list.append(output_array)
+        if 'y_final' in solution:
+            self.store_final_state(solution.y_final)
+        else:
+            self.store_final_state(solution.y[:, self.n_t_steps-1])
+
+    def store_final_state(self, y_final):
+        """Convert the final state of simulation number self.sim_counter to output (stored in self.output_list).
+
+        :param y_final: final positions and velocities, in the same layout as y in newton_equations"""
+        pool = self.starting_conditions
+        channel_idx = self.get_channel_idx(self.sim_counter)
+        self.collect_output(make_output_array(y_final, self.get_charges(self.sim_counter),
+                                              pool.channel_masses[channel_idx], channel_idx, self.sim_counter))
+
+    def collect_output(self, output_array, accumulate=True):
+        """Store the output array of one simulation: update the accumulators (see add_accumulator), and
+        unless keep_output was False, store it in self.output_list or in the result sink of the run.
+
+        :param output_array: output array (see make_output_array), or None if it was not kept
+        :param accumulate: if True, update the accumulators with output_array"""
+        if accumulate:
+            for accumulator in self.accumulators.values():
+                accumulator.update(output_array)
+        if not self.keep_output:
+            return
+        if self.result_sink:
+            self.result_sink.add(output_array)
+        else:
+            self.output_list.append(output_array)
+
+    def add_accumulator(self, name, accumulator):
+        """Register an accumulator (see HistogramAccumulator), updated with the final state of every
+        simulation of the following runs. It is reset at the start of each run.
+
+        :param name: name of the accumulator, in self.accumulators
+        :param accumulator: accumulator object, e.g. KESpectrum(ke_range=(0, 50))"""
+        self.accumulators[name] = accumulator
+
+    def __getattr__(self, name):
+        # with a result sink, output_arr and output_df are only read from disk when first used
+        if name in ['output_arr', 'output_df'] and self.__dict__.get('result_sink'):
+            self.output_arr = self.result_sink.to_arr()
+            self.output_df = make_output_df(self.output_arr)
+            return(getattr(self, name))
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def get_channel_idx(self, sim_counter):
+        """Index of the CE channel of a simulation (0 if no channels were set)."""
+        if getattr(self, 'stream_chunk', None) is not None:
+            start, channel_idx, charges = self.stream_chunk
+            return(int(channel_idx[sim_counter-start]))
+        return(int(self.starting_conditions.samp_channel_idx[sim_counter]))
+
+    def get_charges(self, sim_counter):
+        """Charges (in C) of the atoms of a simulation, from its channel or the charge model of the pool."""
+        if getattr(self, 'stream_chunk', None) is not None:
+            start, channel_idx, charges = self.stream_chunk
+            if charges is not None:
+                return(charges[sim_counter-start]*e)
+        elif self.starting_conditions.charge_model is not None:
+            return(self.starting_conditions.samp_charge_arr[sim_counter]*e)
+        return(self.starting_conditions.channel_charges[self.get_channel_idx(sim_counter)])
+
+    def iter_pool_chunks(self, chunk_size, stream=None):
+        """Iterate over the starting conditions in chunks of at most chunk_size samples: slices of the pool
+        of self.starting_conditions, or the chunks of a stream (see StartingConditions.stream_pool), split further
+        if needed. While streaming, the channels and charges of the current chunk are kept in self.stream_chunk
+        for get_channel_idx and get_charges.
+
+        :param chunk_size: maximum number of samples per chunk
+        :param stream: optional generator from StartingConditions.stream_pool
+
+        :return: generator of (index of the first sample, (n,natoms*6) array of initial states,
+        (n,) array of channel indices, (n,natoms) array of charges (in units of e) or None) tuples"""
+        pool = self.starting_conditions
+        if stream is None:
+            self.stream_chunk = None
+            n_samples = len(pool.samp_y0_list)
+            for start in range(0, n_samples, chunk_size):
+                stop = min(start+chunk_size, n_samples)
+                charges = pool.samp_charge_arr[start:stop] if pool.charge_model is not None else None
+                yield(start, pool.samp_y0_list[start:stop], pool.samp_channel_idx[start:stop], charges)
+            return
+        for stream_start, y0, channel_idx, charges in stream:
+            self.stream_chunk = (stream_start, channel_idx, charges)
+            for i in range(0, len(y0), chunk_size):
+                yield(stream_start+i, y0[i:i+chunk_size], channel_idx[i:i+chunk_size],
+                      None if charges is None else charges[i:i+chunk_size])
 
     def output_list_to_arr(self):
         """Convert simulation output from list of arrays (self.output_list) 
@@ -817,50 +3667,329 @@ class CESim:
 
     def output_list_to_df(self):
         """Convert simulation output from list of arrays to a Pandas dataframe
-        (stored in self.output_df)"""
-        try:
-            self.output_df = pd.DataFrame(self.output_arr, columns = ['vx_ms','vy_ms','vz_ms','charge_C','mass_kg', 'channel_idx', 'sim_counter'])
-        except:
+        (stored in self.output_df, see make_output_df)"""
+        if 'output_arr' not in self.__dict__:
             self.output_list_to_arr()
-            self.output_df = pd.DataFrame(self.output_arr, columns = ['vx_ms','vy_ms','vz_ms','charge_C','mass_kg', 'channel_idx', 'sim_counter'])
-
-        self.output_df['charge_e'] = self.output_df['charge_C']/e
-        self.output_df['mass_amu'] = self.output_df['mass_kg']/u
-
-        self.output_df['px_SI'] = self.output_df['vx_ms']*self.output_df['mass_kg']
-        self.output_df['py_SI'] = self.output_df['vy_ms']*self.output_df['mass_kg']
-        self.output_df['pz_SI'] = self.output_df['vz_ms']*self.output_df['mass_kg']
-
-        self.output_df['px_AU'] = self.output_df['px_SI'] / p_au_fac
-        self.output_df['py_AU'] = self.output_df['py_SI'] / p_au_fac
-        self.output_df['pz_AU'] = self.output_df['pz_SI'] / p_au_fac
-        self.output_df['pmag_AU'] = np.sqrt(self.output_df['px_AU']**2+self.output_df['py_AU']**2+self.output_df['pz_AU']**2)
-
-        self.output_df['KE_eV'] = (self.output_df['pmag_AU']**2)/(2*self.output_df['mass_kg']/u)*p_au_KE_eV_fac
+        self.output_df = make_output_df(self.output_arr)
 
         
 
-    def run_sims(self, n_print=100, save_all=False, make_df=True, verbose=False):
-        """Simulate CE for each starting condition"""
+    def make_force_engine(self, sim_counter):
+        """Create the force engine (see make_engine) for one trajectory, with the settings of run_sims
+        and the per-channel tables of the pool (see StartingConditions.build_channel_cache).
+
+        :param sim_counter: simulation number
+
+        :return: force engine object"""
+        pool = self.starting_conditions
+        channel_idx = self.get_channel_idx(sim_counter)
+        return(make_engine(self.get_charges(sim_counter), pool.channel_masses[channel_idx], self.settings))
+
+    def run_sims(self, n_print=100, save_all=False, make_df=True, verbose=False,
+                 force_method='vectorized', force_kwargs=None, batch_size=None, rtol=1e-3, atol=1e-6,
+                 n_workers=None, chunk_size=10, integrator='RK45', integrator_kwargs=None, asymptotic_fraction=None,
+                 ke_convergence=None, ke_window=1e-12, units='SI', final_state_only=None, tmax=None,
+                 trajectory_store=None, result_sink=None, keep_output=True, stream=None):
+        """Simulate CE for each starting condition
+
+        The options combine as follows. n_workers (parallel processes), integrator, asymptotic_fraction and
+        ke_convergence (early stopping), units, final_state_only, trajectory_store, result_sink, keep_output and stream
+        can all be used together, with any force_method except 'loop' (which is serial, in SI units, with solve_ivp
+        and without early stopping). batch_size (run_batched) always integrates to tmax with its own RK45 and direct
+        summation forces, so it only combines with units, rtol, atol, result_sink, keep_output, accumulators and
+        stream, and raises a ValueError for any other option it cannot honour.
+
+        :param n_print: if verbose, print progress every n_print simulations
+        :param save_all: if True, keep every ODE solution in self.solution_list
+        :param make_df: if True, convert the output to a dataframe (self.output_df)
+        :param verbose: if True, print progress
+        :param force_method: ['vectorized', 'barnes_hut', 'fmm', 'loop'] method used to calculate the Coulomb forces.
+        'vectorized' is the fast NumPy kernel (coulomb_forces), 'barnes_hut' is the tree code
+        (BarnesHutEngine) and 'fmm' the fast multipole method (FMMEngine) for large clusters,
+        'loop' is the original pairwise loop in self.newton_equations
+        :param force_kwargs: optional dict of keyword arguments passed to the force engine,
+        e.g. {'theta': 0.3, 'error_samples': 100} for 'barnes_hut' or {'order': 6} for 'fmm'.
+        Any force errors and per-phase timings the engine reports are stored per simulation in
+        self.force_error_list and self.force_timing_list
+        :param batch_size: if set, integrate this many starting conditions at once with the batched
+        integrator (see run_batched) instead of one solve_ivp call per starting condition. Best for small molecules
+        :param rtol: relative tolerance of the ODE solver (default 1e-3, as solve_ivp)
+        :param atol: absolute tolerance of the ODE solver (default 1e-6, as solve_ivp)
+        :param n_workers: if >1, spread the simulations over this many processes (see run_parallel).
+        The output is identical to a serial run
+        :param chunk_size: number of simulations sent to a worker process at once (default 10)
+        :param integrator: 'verlet' or 'yoshida4' for the symplectic integrators (see integrate_symplectic),
+        otherwise the solve_ivp method (default 'RK45'). For the symplectic integrators the relative energy drift
+        of each simulation is stored in self.energy_drift_list
+        :param integrator_kwargs: optional dict of keyword arguments passed to the integrator,
+        e.g. {'eta': 0.01} for the symplectic integrators
+        :param asymptotic_fraction: if set, stop each trajectory once its Coulomb potential energy falls below
+        this fraction of the total energy (e.g. 0.01), and add the remaining potential energy to the final
+        velocities analytically (see asymptotic_extrapolation). The stop time and added energy of each
+        simulation are stored in self.termination_df
+        :param ke_convergence: if set, stop each trajectory once the relative change of every ion's kinetic energy
+        over ke_window falls below this threshold (e.g. 1e-4). The output is the state at the stop time,
+        and the stop time of each simulation is stored in self.termination_df
+        :param ke_window: time window (in s) for ke_convergence (default 1e-12)
+        :param units: unit system the equations of motion are integrated in (see unit_system_dict), default 'SI'.
+        In 'natural' units (angstrom, fs, u, e) all state variables are of order one, so rtol and atol act evenly
+        on positions and velocities. Inputs and outputs stay in SI
+        :param final_state_only: if True, integrate each trajectory to tmax and keep only its final state,
+        without evaluating the solution at the timebins (see integrate_final_state). Default is True unless save_all
+        :param tmax: time (in s) to integrate to. Default is the last of the timebins (see make_timebins),
+        which are only needed if the trajectories are recorded (save_all or trajectory_store)
+        :param trajectory_store: optional TrajectoryStore, to record the trajectories (decimated, for selected atoms,
+        in float32) on disk instead of keeping every solution in memory as save_all does
+        :param result_sink: optional ResultSink, to write the output to disk in shards during the run instead of
+        keeping it in self.output_list. self.output_arr and self.output_df are then read from the shards when first
+        used, and make_df is ignored
+        :param keep_output: if False, do not keep the output of each simulation, only the diagnostics and the
+        registered accumulators (see add_accumulator), so the memory used does not grow with the number of simulations
+        :param stream: optional generator of starting conditions from StartingConditions.stream_pool, simulated as it
+        is sampled instead of the pool of self.starting_conditions. Each chunk is integrated as soon as it is generated,
+        so the first simulations start straight away and the memory used does not depend on the number of samples"""
+        if batch_size:
+            unsupported = {'save_all': save_all, 'trajectory_store': trajectory_store,
+                           'force_method': force_method!='vectorized', 'force_kwargs': force_kwargs,
+                           'integrator': integrator!='RK45', 'integrator_kwargs': integrator_kwargs,
+                           'asymptotic_fraction': asymptotic_fraction, 'ke_convergence': ke_convergence,
+                           'final_state_only': final_state_only is False, 'n_workers': n_workers and n_workers>1}
+            unsupported = [name for name, value in unsupported.items() if value]
+            if unsupported:
+                raise ValueError(f"Batched integration (batch_size) only integrates to tmax with RK45 and direct "
+                                 f"summation forces, and cannot be combined with: {unsupported}")
         self.output_list=[]
+        for name in ['output_arr', 'output_df']:
+            self.__dict__.pop(name, None)
+        self.result_sink=result_sink
+        self.keep_output=keep_output
+        for accumulator in self.accumulators.values():
+            accumulator.reset()
+        if result_sink:
+            result_sink.start()
         self.save_all=save_all
         self.verbose=verbose
+        self.rtol=rtol
+        self.atol=atol
+        self.termination_list = []
+        self.trajectory_store = None
+        unit_scales(units)
+        if final_state_only is None:
+            final_state_only = not (save_all or trajectory_store)
+        if tmax is not None:
+            self.tmax = tmax
+        elif not hasattr(self, 'tmax'):
+            raise ValueError("Set the time to integrate to with tmax, or the timebins with make_timebins")
+        if not final_state_only and not hasattr(self, 'timebins'):
+            raise ValueError("Recording trajectories needs timebins, see make_timebins")
+        if batch_size:
+            self.run_batched(batch_size, n_print=n_print, verbose=verbose, units=units, stream=stream)
+            self.finish_run(make_df)
+            return
+        if force_method!='loop' and force_method not in force_engine_dict:
+            raise ValueError(f"Unknown force method {force_method}. Options are: "
+                             f"{['loop'] + list(force_engine_dict)}")
+        if force_method=='loop' and (integrator in symplectic_integrator_list or asymptotic_fraction or ke_convergence):
+            raise ValueError("The symplectic integrators and early stopping need a force engine, not force_method='loop'")
+        if force_method=='loop' and units!='SI':
+            raise ValueError("force_method='loop' only integrates in SI units")
+        self.force_method=force_method
+        self.force_kwargs=force_kwargs if force_kwargs else {}
+        self.settings = {'force_method': self.force_method, 'force_kwargs': self.force_kwargs,
+                         'integrator': integrator, 'integrator_kwargs': integrator_kwargs if integrator_kwargs else {},
+                         'tmax': self.tmax, 'timebins': getattr(self, 'timebins', None), 'rtol': rtol, 'atol': atol,
+                         'save_all': save_all, 'asymptotic_fraction': asymptotic_fraction,
+                         'ke_convergence': ke_convergence, 'ke_window': ke_window, 'units': units,
+                         'final_state_only': final_state_only, 'trajectory_selection': None}
+        self.trajectory_store = trajectory_store
+        if trajectory_store:
+            n_samples = self.starting_conditions.n_geoms if stream else len(self.starting_conditions.samp_y0_list)
+            trajectory_store.start(n_samples, self.timebins)
+            self.settings['trajectory_selection'] = trajectory_store.selection
         if self.save_all:
             self.solution_list = []
+        self.force_error_list = []
+        self.force_timing_list = []
+        self.energy_drift_list = []
+        if n_workers and n_workers>1:
+            self.run_parallel(n_workers, chunk_size=chunk_size, n_print=n_print, verbose=verbose, stream=stream)
+            self.finish_run(make_df)
+            return
         self.sim_counter=0
-        for y0 in self.starting_conditions.samp_y0_list:
-            solution = solve_ivp(self.newton_equations, [0, self.tmax], y0, t_eval = self.timebins)
+        for y0 in (y0 for _, y0_chunk, _, _ in self.iter_pool_chunks(chunk_size, stream) for y0 in y0_chunk):
+            if self.force_method=='loop':
+                engine = None
+                rhs = self.newton_equations
+            else:
+                engine = self.make_force_engine(self.sim_counter)
+                rhs = engine.newton_equations
+            solution = integrate_trajectory(rhs, engine, y0, self.settings)
+            self.store_diagnostics(self.sim_counter, getattr(engine, 'force_errors', None),
+                                   getattr(engine, 'timings', None), solution_diagnostics(solution))
             if save_all:
                 self.solution_list.append(solution)
+            if trajectory_store:
+                trajectory_store.add(self.sim_counter,
+                                     *select_trajectory(solution.t, solution.y, **trajectory_store.selection))
             self.store_output(solution)
             if self.sim_counter%n_print==0:
                 if verbose:
                     print(f'On simulation number {self.sim_counter}!')
             self.sim_counter+=1
-        if make_df:
+        self.finish_run(make_df)
+
+    def store_diagnostics(self, sim_counter, force_errors, timings, diagnostics):
+        """Store the diagnostics of one simulation, where available: force engine errors and timings,
+        energy drift of the integrator, and the stop time and analytically added potential energy
+        of trajectories stopped early (in self.termination_list).
+
+        :param sim_counter: simulation number
+        :param force_errors: force errors reported by the force engine, or None
+        :param timings: per-phase timings reported by the force engine, or None
+        :param diagnostics: dict from solution_diagnostics"""
+        if force_errors:
+            self.force_error_list.append(force_errors)
+        if timings:
+            self.force_timing_list.append(timings)
+        if 'energy_drift' in diagnostics:
+            self.energy_drift_list.append(diagnostics['energy_drift'])
+        if 't_stop' in diagnostics or 'pe_residual' in diagnostics:
+            self.termination_list.append({'sim_counter': sim_counter,
+                                          't_stop': diagnostics.get('t_stop', self.tmax),
+                                          'stopped_early': 't_stop' in diagnostics,
+                                          'PE_residual_J': diagnostics.get('pe_residual', 0.)})
+
+    def finish_run(self, make_df):
+        """Convert the stored output of a run: the output to a dataframe (if make_df), and the
+        early stopping record to self.termination_df (with the integration time saved, t_saved,
+        for each simulation). Closes the trajectory store, if one was used."""
+        self.stream_chunk = None
+        if getattr(self, 'trajectory_store', None):
+            self.trajectory_store.close()
+        if self.result_sink:
+            self.result_sink.close()
+        elif make_df and self.keep_output:
+            # rebuild the array so a repeated run does not reuse a stale self.output_arr
+            self.output_list_to_arr()
             self.output_list_to_df()
-
-
+        if self.termination_list:
+            self.termination_df = pd.DataFrame(self.termination_list)
+            self.termination_df['PE_residual_eV'] = self.termination_df['PE_residual_J']/e
+            self.termination_df['t_saved'] = self.tmax - self.termination_df['t_stop']
+            if self.verbose:
+                print(f"{np.sum(self.termination_df['stopped_early'])} simulations stopped early, saving "
+                      f"{np.mean(self.termination_df['t_saved'])/self.tmax:.1%} of the integration time")
+
+    def run_parallel(self, n_workers, chunk_size=10, n_print=100, verbose=False, stream=None):
+        """Simulate CE for the starting conditions with a pool of worker processes. Chunks of samples,
+        with their charges, masses and channel, are sent to the workers (run_sim_chunk) and the results are
+        stored in order of sim_counter as soon as all earlier ones are done, so the output is identical
+        to a serial run of run_sims. At most 2*n_workers chunks are in flight, so a stream is only
+        sampled as fast as the workers consume it.
+        Uses the settings (force method, integrator etc.) stored in self.settings by run_sims.
+
+        :param n_workers: number of worker processes
+        :param chunk_size: number of simulations sent to a worker at once (default 10)
+        :param n_print: if verbose, print progress every n_print simulations
+        :param verbose: if True, print progress
+        :param stream: optional generator from StartingConditions.stream_pool (see run_sims)"""
+        if self.force_method=='loop':
+            raise ValueError("force_method='loop' depends on self.sim_counter and cannot run in parallel")
+        pool = self.starting_conditions
+        n_samples = pool.n_geoms if stream else len(pool.samp_y0_list)
+        chunks = ([(start+i, y0[i], pool.channel_charges[channel_idx[i]] if charges is None else charges[i]*e,
+                    pool.channel_masses[channel_idx[i]], int(channel_idx[i])) for i in range(len(y0))]
+                  for start, y0, channel_idx, charges in self.iter_pool_chunks(chunk_size, stream))
+
+        pending = {}
+        n_stored = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            settings = dict(self.settings, accumulators=self.accumulators, keep_output=self.keep_output)
+            futures = set()
+            for chunk in chunks:
+                futures.add(executor.submit(run_sim_chunk, chunk, settings))
+                if len(futures)>=2*n_workers:
+                    done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    n_stored = self.store_parallel_results(done, pending, n_stored, n_samples, n_print, verbose)
+            n_stored = self.store_parallel_results(futures, pending, n_stored, n_samples, n_print, verbose)
+        self.sim_counter = n_stored
+
+    def store_parallel_results(self, futures, pending, n_stored, n_samples, n_print=100, verbose=False):
+        """Collect the results of finished run_sim_chunk calls (see run_parallel), and store them in order of
+        sim_counter, as soon as all earlier ones are done.
+
+        :param futures: futures of run_sim_chunk calls
+        :param pending: dict of results received but not yet stored, by sim_counter (updated)
+        :param n_stored: number of simulations stored so far
+        :param n_samples: total number of simulations, for the progress messages
+        :param n_print: if verbose, print progress every n_print simulations
+        :param verbose: if True, print progress
+
+        :return: number of simulations stored"""
+        for future in concurrent.futures.as_completed(futures):
+            n_done = n_stored + len(pending)
+            results, accumulators = future.result()
+            for name, accumulator in accumulators.items():
+                self.accumulators[name].merge(accumulator)
+            for result in results:
+                pending[result[0]] = result
+            if verbose and (n_stored+len(pending))//n_print > n_done//n_print:
+                print(f'Finished {n_stored+len(pending)} of {n_samples} simulations!')
+            while n_stored in pending:
+                (sim_counter, output_array, force_errors, timings, diagnostics,
+                 solution, trajectory) = pending.pop(n_stored)
+                self.collect_output(output_array, accumulate=False)
+                self.store_diagnostics(sim_counter, force_errors, timings, diagnostics)
+                if self.save_all:
+                    self.solution_list.append(solution)
+                if trajectory is not None:
+                    self.trajectory_store.add(sim_counter, *trajectory)
+                n_stored += 1
+        return(n_stored)
+
+    def run_batched(self, batch_size, n_print=100, verbose=False, units='SI', stream=None):
+        """Simulate CE for the starting conditions in batches. Each batch is stacked into a
+        (batch_size, natoms*6) array and advanced together by rk45_batched, with vectorized forces
+        (BatchedCoulombEngine) and a separate adaptive step size for each sample. The output is stored
+        in self.output_list, as for run_sims. The number of function evaluations for each sample is
+        stored in self.nfev_arr.
+
+        :param batch_size: number of starting conditions integrated at once
+        :param n_print: if verbose, print progress every n_print simulations
+        :param verbose: if True, print progress
+        :param units: unit system the batch is integrated in (see unit_system_dict), default 'SI'
+        :param stream: optional generator from StartingConditions.stream_pool (see run_sims)"""
+        scales = unit_scales(units)
+        pool = self.starting_conditions
+        nfev_list = []
+        self.sim_counter=0
+        for start, y0, channel_idx, charges in self.iter_pool_chunks(batch_size, stream):
+            if charges is None:
+                engine = BatchedCoulombEngine(pool.channel_charges/scales['charge'], pool.channel_masses/scales['mass'],
+                                              coulomb_k=scales['coulomb_k'], channel_idx=channel_idx)
+                charges = pool.channel_charges[channel_idx]
+            else:
+                # with a charge model, every sample has its own charges
+                charges = charges*e
+                engine = BatchedCoulombEngine(charges/scales['charge'], pool.channel_masses[channel_idx]/scales['mass'],
+                                              coulomb_k=scales['coulomb_k'])
+            y0 = scale_state(np.array(y0).T, scales).T
+            y_final, nfev = rk45_batched(engine.newton_equations, y0, self.tmax/scales['time'],
+                                         rtol=self.rtol, atol=self.atol)
+            y_final = scale_state(y_final.T, scales, to_internal=False).T
+            nfev_list.append(nfev)
+            # output of the whole batch at once, then stored per simulation
+            output_array = make_output_array(y_final, charges, pool.channel_masses[channel_idx], channel_idx,
+                                             np.arange(start, start+len(y_final)))
+            for accumulator in self.accumulators.values():
+                accumulator.update(output_array)
+            for sim_output in np.split(output_array, len(y_final)):
+                self.collect_output(sim_output, accumulate=False)
+                if self.sim_counter%n_print==0:
+                    if verbose:
+                        print(f'On simulation number {self.sim_counter}!')
+                self.sim_counter+=1
+        self.nfev_arr = np.concatenate(nfev_list)
 
     def newton_equations(self,t,y):
         """Setup Newton equations for ODE solver.
@@ -874,8 +4003,9 @@ class CESim:
 
         """
 
-        charges = self.starting_conditions.samp_charges_list[self.sim_counter]
-        masses = self.starting_conditions.samp_masses_list[self.sim_counter]
+        channel_idx = self.get_channel_idx(self.sim_counter)
+        charges = self.get_charges(self.sim_counter)
+        masses = self.starting_conditions.channel_masses[channel_idx]
         
         dydt = np.zeros((np.shape(y)))
         n_atoms = np.shape(y)[0]/6